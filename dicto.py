@@ -3,9 +3,18 @@ from __future__ import print_function
 import os
 import io
 import re
-import ssl
+import gzip
+import copy
+import json
+import time
+import bisect
 import shutil
+import fnmatch
+import hashlib
 import inspect
+import importlib
+import itertools
+import threading
 import tempfile
 import datetime
 import traceback
@@ -13,30 +22,23 @@ import functools
 import subprocess
 import contextlib
 import collections
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
 
 import six
-import yaml
+from six.moves import cPickle as pickle
 import click
 import jinja2
-import natsort
-import requests
+import jinja2.meta
 
-import git
-import hglib
-import redmine
-try:
-    import chef
-except (ImportError, SyntaxError) as error:
-    click.secho(u'chef will not be available in this platform'
-                .format(six.text_type(error)), fg=u'yellow')
+# Resource backends (git, hglib, redmine, chef, requests...) are imported
+# only by the resources using them, keeping the command startup fast.
+
+
+def get_dicto_home():
+    return os.getenv('DICTO_HOME', click.get_app_dir(u'dicto', force_posix=True))
 
 
 def get_default_config_paths():
-    HOME = os.getenv('DICTO_HOME', click.get_app_dir(u'dicto', force_posix=True))
+    HOME = get_dicto_home()
     return [
         os.path.join(os.getcwd(), u'.dicto.yaml'),             # local config
         os.path.join(os.getcwd(), u'.dicto', u'config.yaml'),  # project config
@@ -105,6 +107,7 @@ def _parse_option_file(ctx, param, value):
         # open and read all files
         for name in value:
             path = os.path.abspath(value[name])
+            ctx.meta.setdefault(u'file_paths', {})[name] = path  # for --watch
             with io.open(path, encoding='utf-8') as stream:
                 value[name] = stream.read().strip()
         return value
@@ -112,7 +115,12 @@ def _parse_option_file(ctx, param, value):
         raise click.BadParameter(u'Option must keep a key:path format')
 
 
-def _parse_option_apt_packages(ctx, param, value):
+redmine_prefetchable = (u'journals', u'relations', u'assigned_to')
+
+render_modes = (u'write', u'append', u'prepend')
+
+
+def _parse_option_multiple(ctx, param, value):
     if not value:
         return []
     return value
@@ -123,24 +131,51 @@ def common_data_options(function):
     options = [
         click.option(u'--chef/--no-chef', is_flag=True, default=None,
                      help="enable/disable chef resource (default: false)"),
+        click.option(u'--chef-insecure/--no-chef-insecure', is_flag=True, default=None,
+                     help="skip chef server certificate verification (default: false)"),
+        click.option(u'--chef-jobs', type=click.IntRange(min=1),
+                     help="Max chef server connections open at the same time (default: 8)"),
+        click.option(u'--chef-query',
+                     help="chef search query for the nodes to get, e.g. role:web (default: all)"),
+        click.option(u'--chef-attributes', multiple=True, callback=_parse_option_multiple,
+                     help=("Node attribute to get as name:dotted.path, e.g. "
+                           "ip:ipaddress. Can be used multiple times "
+                           "(default: name, chef_environment, run_list)")),
         click.option(u'--apt/--no-apt', is_flag=True, default=None,
                      help="enable/disable apt resource (default: false)"),
         click.option(u'--apt-url', envvar='APT_URL',
                      help="apt repository base url envvar: APT_URL"),
-        click.option(u'--apt-packages', multiple=True, callback=_parse_option_apt_packages,
+        click.option(u'--apt-packages', multiple=True, callback=_parse_option_multiple,
                      help="apt packages to include."),
+        click.option(u'--apt-jobs', type=click.IntRange(min=1),
+                     help="Max apt packages fetched at the same time (default: 8)"),
+        click.option(u'--apt-backend', type=click.Choice([u'pool', u'index']),
+                     help="Read apt pool directories or Packages indexes (default: pool)"),
+        click.option(u'--apt-index', multiple=True, callback=_parse_option_multiple,
+                     help=("apt Packages(.gz) index path within apt url. Can be used "
+                           "multiple times (default: dists/stable/main/binary-amd64/Packages.gz)")),
         click.option(u'--git/--no-git', is_flag=True, default=None,
                      help="enable/disable git resource (default: false)"),
         click.option(u'--git-repo', envvar='GIT_REPO',
                      help="mercurial repository PATH/URL  envvar: GIT_REPO"),
         click.option(u'--git-version', envvar='GIT_VERSION',
                      help="Adds git tag to the data  envvar: GIT_VERSION"),
+        click.option(u'--git-backend', type=click.Choice([u'gitpython', u'log']),
+                     help="Read commits using GitPython or bulk git log (default: gitpython)"),
+        click.option(u'--git-stats/--no-git-stats', is_flag=True, default=None,
+                     help="add files and lines changed by version commits (default: false)"),
         click.option(u'--hg/--no-hg', is_flag=True, default=None,
                      help="enable/disable mercurial resource (default: false)"),
         click.option(u'--hg-repo', envvar='HG_REPO',
                      help="mercurial repository PATH/URL envvar: HG_REPO"),
         click.option(u'--hg-version', envvar='HG_VERSION',
                      help="mercurial add tag to the data evvar: HG_VERSION"),
+        click.option(u'--hg-mirror/--no-hg-mirror', is_flag=True, default=None,
+                     help="keep remote repositories mirrored in DICTO_HOME (default: true)"),
+        click.option(u'--hg-revset',
+                     help="mercurial commits to read into hg_commits (default: all, newest first)"),
+        click.option(u'--hg-log-limit', type=click.IntRange(min=1),
+                     help="read at most this many commits into hg_commits"),
         click.option(u'--redmine/--no-redmine', is_flag=True, default=None,
                      help="enable/disable redmine resource (default: false)"),
         click.option(u'--redmine-url', envvar='REDMINE_URL',
@@ -155,11 +190,34 @@ def common_data_options(function):
                      help="redmine user's password envvar: REDMINE_PASSWORD"),
         click.option(u'--redmine-key', envvar='REDMINE_KEY',
                      help="redmine user's key token envvar: REDMINE_KEY"),
+        click.option(u'--redmine-bulk/--no-redmine-bulk', is_flag=True, default=None,
+                     help="fetch redmine_issues as plain dicts, many pages at a time (default: false)"),
+        click.option(u'--redmine-jobs', type=click.IntRange(min=1),
+                     help="Max redmine issue pages fetched at the same time (default: 4)"),
+        click.option(u'--redmine-include', multiple=True, callback=_parse_option_multiple,
+                     help="Issue associations to include in bulk mode, e.g. relations. Can be used multiple times"),
+        click.option(u'--redmine-fields', multiple=True, callback=_parse_option_multiple,
+                     help="Issue fields to keep in bulk mode (default: all). Can be used multiple times"),
+        click.option(u'--redmine-prefetch', multiple=True, callback=_parse_option_multiple,
+                     type=click.Choice(redmine_prefetchable),
+                     help="Issue attributes to get for all issues up front. Can be used multiple times"),
+        click.option(u'--redmine-store/--no-redmine-store', is_flag=True, default=None,
+                     help="keep redmine issues in a local store synced by changes (default: false)"),
+        click.option(u'--prune/--no-prune', is_flag=True, default=None,
+                     help="only fetch resources the template uses (default: false)"),
+        click.option(u'--cache/--no-cache', is_flag=True, default=None,
+                     help="enable/disable the resources cache (default: true)"),
+        click.option(u'--refresh', is_flag=True, default=None,
+                     help="Fetches resources again ignoring cached data"),
+        click.option(u'--jobs', type=click.IntRange(min=1), envvar='DICTO_JOBS',
+                     help="Max resources fetched at the same time envvar: DICTO_JOBS"),
         click.option(u'--data', callback=_parse_option_data, multiple=True,
                      help="Extra data in key:value format. Can be used multiple times."),
         click.option(u'--exe', multiple=True, callback=_parse_option_data,
                      help=(u'Extra data from external program output. '
                            u'key:command format. Can be used multiple times')),
+        click.option(u'--exe-timeout', type=float,
+                     help="Seconds before killing --exe commands (default: none)"),
         click.option(u'--template', type=click.Path(exists=True, dir_okay=False, resolve_path=True),
                      envvar='DICTO_TEMPLATE', help="Path to a Jinja2 template."),
         click.option(u'--profile', envvar='DICTO_PROFILE',
@@ -183,18 +241,152 @@ def common_data_options(function):
               help="Writes output to file")
 @click.option(u'-a', u'--append', type=click.File(mode='a', encoding='utf-8'),
               help="Appends output to file")
-@click.option(u'-p', u'--prepend', type=click.File(mode='r+', encoding='utf-8'),
+@click.option(u'-p', u'--prepend',
+              type=click.Path(exists=True, dir_okay=False, writable=True),
               help="Prepends output to existing file")
-def view(obj, output, append, prepend, **kwargs):
+@click.option(u'--explain', is_flag=True, default=False,
+              help="Prints which resources are pruned and why (implies --prune)")
+@click.option(u'--all-profiles', is_flag=True, default=False,
+              help="Renders once by profile in config, as --profile '*'")
+@click.option(u'--output-path',
+              help="Output path template for each profile, e.g. out/{{profile}}.txt")
+@click.option(u'--output-mode', type=click.Choice(render_modes), default=u'write',
+              help="How to write each profile output  [default: write]")
+@click.option(u'--watch', is_flag=True, default=False,
+              help="Renders again when the template, config, --file inputs "
+              "or git refs change")
+def view(obj, output, append, prepend, explain, all_profiles, output_path,
+         output_mode, watch, **kwargs):
+    profiles = match_profiles(obj['config'], u'*' if all_profiles else kwargs.get(u'profile'))
+    if profiles is not None and (output or append or prepend):
+        error(u'Use --output-path and --output-mode to render many profiles')
+    if profiles is not None:
+        return view_profiles(obj, profiles, kwargs, explain, output_path, output_mode)
+    if watch and (append or prepend):
+        error(u'--watch writes to stdout or --output')
+    if watch:
+        return watch_view(obj, kwargs, explain, output)
+
     kwargs = resolve_args(obj['config'], kwargs)
+    if explain:
+        kwargs[u'prune'] = True
 
     echo(obj, u'Obtaining external data', level='verbose')
-    context = make_context(kwargs)
+    context = make_context(kwargs, explain)
     echo(obj, u'Render context:\n {!r}'.format(context), level='debug')
 
     template = kwargs.get(u'template') or error(u'No template given')
 
-    write_output(render_template(template, context), output, append, prepend)
+    write_output(stream_template(template, context), output, append, prepend)
+
+
+def view_profiles(obj, profiles, kwargs, explain, output_path, output_mode):
+    """Renders the template of every profile to its own output path
+
+    Profiles fetching a resource with the same arguments share a
+    single fetch of it.
+    """
+    if not output_path:
+        error(u'--output-path is needed to render many profiles')
+
+    profiles_kwargs = []
+    for profile in profiles:
+        profile_kwargs = resolve_args(copy.deepcopy(obj['config']), dict(kwargs, profile=profile))
+        if explain:
+            profile_kwargs[u'prune'] = True
+        profiles_kwargs.append(profile_kwargs)
+    kwargs = resolve_args(copy.deepcopy(obj['config']), dict(kwargs, profile=None))
+
+    echo(obj, u'Obtaining external data for {} profiles'.format(len(profiles)), level='verbose')
+    contexts = make_contexts(profiles_kwargs, kwargs, explain)
+
+    targets = [render_target(context.get(u'template') or error(u'No template given for profile ' + profile),
+                             render_output_path(output_path, context), output_mode)
+               for profile, context in zip(profiles, contexts)]
+    repeated = [path for path, count in collections.Counter(
+        target.output for target in targets).items() if count > 1]
+    if repeated:
+        error(u'Many profiles would be written to: {}'.format(u', '.join(sorted(repeated))))
+
+    render_profiles(targets, contexts, kwargs.get(u'jobs'))
+
+
+def watch_view(obj, kwargs, explain, output):
+    """Renders the template again each time its inputs change"""
+    echo(obj, u'Obtaining external data', level='verbose')
+    watched = WatchedContext(obj['config_path'], kwargs,
+                             click.get_current_context().meta.get(u'file_paths'), explain)
+    render_watched(watched, output)
+
+    try:
+        while True:
+            sources = watched.sources()
+            for changed in iter_changes(sources):
+                kinds = set(sources[path] for path in changed)
+                echo(obj, u'Changed: {}'.format(u', '.join(sorted(changed))), level='verbose')
+                try:
+                    watched.update(kinds)
+                except Exception as exception:
+                    click.echo(describe_exception(exception), err=True)
+                    continue
+                render_watched(watched, output)
+                if watched.sources() != sources:
+                    break  # watch the new inputs
+    except KeyboardInterrupt:
+        pass
+
+
+def render_watched(watched, output=None):
+    """Renders a watched context reporting errors instead of failing"""
+    template = watched.kwargs.get(u'template') or error(u'No template given')
+    try:
+        if output:
+            output.seek(0)
+            output.truncate()
+        write_output(stream_template(template, watched.context()), output)
+    except Exception as exception:
+        click.echo(describe_exception(exception), err=True)
+
+
+def match_profiles(config, pattern):
+    """Names of the profiles matching a glob *pattern*, None if not a glob"""
+    if not pattern or not any(char in pattern for char in u'*?['):
+        return None
+
+    profiles = sorted(name for name in config.get(u'profiles') or {}
+                      if fnmatch.fnmatchcase(name, pattern))
+    if not profiles:
+        error(u'No profiles matching "{}"'.format(pattern))
+    return profiles
+
+
+def render_output_path(output_path, context):
+    path = jinja2.Template(output_path).render(context)
+    directory = os.path.dirname(os.path.abspath(path))
+    make_dirs(directory)
+    return path
+
+
+@cli.command(u'render-batch')
+@manage_errors
+@click.pass_obj
+@common_data_options
+@click.argument(u'manifest', type=click.Path(exists=True, dir_okay=False, resolve_path=True))
+def render_batch(obj, manifest, **kwargs):
+    """Renders many templates from a single context
+
+    MANIFEST is a yaml list of targets with a template, an output path
+    and a write, append or prepend mode. Paths are relative to the
+    manifest and targets without output are written to stdout.
+    """
+    kwargs = resolve_args(obj['config'], kwargs)
+    targets = read_manifest(manifest)
+
+    echo(obj, u'Obtaining external data', level='verbose')
+    context = make_context(kwargs, templates=[target.template for target in targets])
+    echo(obj, u'Render context:\n {!r}'.format(context), level='debug')
+
+    render_targets(targets, context, kwargs.get(u'jobs'))
 
 
 @cli.command()
@@ -229,6 +421,60 @@ def context(obj, **kwargs):
     print_subdict(file, 'file')
 
 
+@cli.command()
+@manage_errors
+@click.pass_obj
+@common_data_options
+@click.option(u'--host', default=u'127.0.0.1', show_default=True,
+              help="Address to listen on")
+@click.option(u'--port', type=click.IntRange(min=0), default=8080, show_default=True,
+              help="Port to listen on")
+def serve(obj, host, port, **kwargs):
+    """Serves rendered templates over HTTP
+
+    GET /view?profile=NAME renders the template of a profile, with
+    optional data=key:value parameters. Fetched resources are kept for
+    their cache_ttl seconds. GET /health and /metrics describe the
+    server state as JSON.
+    """
+    server = make_render_server(RenderService(obj['config_path'], kwargs), host, port)
+    click.echo(u'Serving on http://{}:{}'.format(*server.server_address[:2]), err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.group(u'cache')
+def cache_group():
+    """Manages the resources cache"""
+
+
+@cache_group.command(u'stats')
+@manage_errors
+def cache_stats():
+    """Shows cache size and hit rates"""
+    for cache in get_caches():
+        click.echo(u'path: {}'.format(cache.path))
+        click.echo(u'entries: {}'.format(len(cache.entries())))
+        click.echo(u'size: {:.1f} KiB'.format(cache.size() / 1024.0))
+
+        for name, counts in sorted(cache.read_stats().items()):
+            hits, misses = counts.get(u'hits', 0), counts.get(u'misses', 0)
+            click.echo(u'{}: {} hits, {} misses ({:.0%} hit rate)'.format(
+                name, hits, misses, float(hits) / ((hits + misses) or 1)))
+
+
+@cache_group.command(u'clear')
+@manage_errors
+def cache_clear():
+    """Removes all cached data"""
+    removed = sum(cache.clear() for cache in get_caches())
+    click.echo(u'Removed {} cache entries'.format(removed))
+
+
 def print_subdict(data, name=None):
     prefix = u''
     if name:
@@ -239,33 +485,71 @@ def print_subdict(data, name=None):
         click.echo(u'{}{}: {}'.format(prefix, key, value))
 
 
-def make_context(kwargs):
-    """Builds template context from all data resources"""
+def make_context(kwargs, explain=False, templates=None):
+    """Builds template context from all data resources
+
+    When pruning, resources whose variables are not used by the
+    template, or by any of *templates* if given, are not fetched.
+    *explain* prints what gets pruned.
+    """
+    context, plans = plan_context(kwargs, explain, templates)
+    return update_context(context, fetch_plans(plans, kwargs))
+
+
+def make_contexts(contexts_kwargs, kwargs, explain=False):
+    """Builds a context for each argument set fetching once each resource
+
+    Resources planned with the same arguments by many contexts are
+    fetched once, with the jobs and cache settings in *kwargs*.
+    """
+    planned = [plan_context(context_kwargs, explain) for context_kwargs in contexts_kwargs]
+
+    distinct = collections.OrderedDict()
+    for _, plans in planned:
+        for plan in plans:
+            distinct.setdefault(plan_key(plan), plan)
+    fetched = dict(zip(distinct, fetch_plans(list(distinct.values()), kwargs)))
+
+    return [update_context(context, [fetched[plan_key(plan)] for plan in plans])
+            for context, plans in planned]
+
+
+def plan_context(kwargs, explain=False, templates=None):
+    """Context without resources data and the plans of resources to fetch"""
     context = dict(current_date=datetime.datetime.now())
     context.update(kwargs)
     context.update(kwargs['file'])
     context.update(kwargs['data'])
-    context.update(_get_exe_output(kwargs['exe']))
+    context.update(_get_exe_output(
+        kwargs['exe'], kwargs.get(u'exe_timeout'), kwargs.get(u'jobs'),
+        get_exe_cache(kwargs), kwargs.get(u'refresh')))
 
     # make all context variable available as input arguments
     # this allows --data argument:value to be interpreted
     # as if --argument value was set on the command line
     update_no_override(kwargs, context)
 
-    if kwargs.get(u'redmine'):
-        context.update(get_redmine_data(only_args_with(u'redmine_', kwargs)))
+    needs = get_template_needs(kwargs, templates)
+    if explain:
+        explain_resources(kwargs, needs)
 
-    if kwargs.get(u'hg'):
-        context.update(get_hg_data(only_args_with(u'hg_', kwargs)))
+    # all prompting happens here, before any resource is fetched
+    return context, plan_resources(kwargs, needs)
 
-    if kwargs.get(u'chef'):
-        context.update(get_chef_data())
 
-    if kwargs.get(u'apt'):
-        context.update(get_apt_data(only_args_with(u'apt_', kwargs)))
+def fetch_plans(plans, kwargs):
+    """Fetches planned resources using the cache settings in *kwargs*"""
+    cache = get_resource_cache(kwargs)
+    try:
+        return fetch_resources(plans, kwargs.get(u'jobs'), cache)
+    finally:
+        if cache:
+            cache.save_stats()
+
 
-    if kwargs.get(u'git'):
-        context.update(get_git_data(only_args_with(u'git_', kwargs)))
+def update_context(context, fetched):
+    for data in fetched:
+        context.update(data)
 
     if u'redmine_password' in context:
         del context['redmine_password']  # do not print this
@@ -273,6 +557,392 @@ def make_context(kwargs):
     return context
 
 
+resource_plan = collections.namedtuple(
+    u'ResourcePlan', [u'name', u'fetch', u'args', u'needs'])
+
+resource_variables = dict(
+    redmine=(u'redmine_api', u'redmine_issues', u'redmine_project',
+             u'redmine_version'),
+    hg=(u'hg_repo', u'hg_tags', u'hg_commits', u'hg_repo_path',
+        u'hg_version_tag', u'hg_version_commits'),
+    chef=(u'chef_api', u'chef_envs', u'chef_nodes'),
+    apt=(u'apt_packages',),
+    git=(u'git_repo', u'git_tags', u'git_commits', u'git_repo_path',
+         u'git_version_tag', u'git_version_commits', u'git_version_stats'),
+)
+
+
+def get_resources():
+    """Available data resources as (name, prepare, fetch) in merge order"""
+    return [
+        (u'redmine', prepare_redmine_args, fetch_redmine_data),
+        (u'hg', prepare_hg_args, fetch_hg_data),
+        (u'chef', prepare_chef_args, fetch_chef_data),
+        (u'apt', prepare_apt_args, fetch_apt_data),
+        (u'git', prepare_git_args, fetch_git_data),
+    ]
+
+
+def plan_key(plan):
+    """Plans with the same key fetch the same data"""
+    return json.dumps([plan.name, plan.args, sorted(plan.needs) if plan.needs is not None else None],
+                      sort_keys=True, default=repr)
+
+
+def plan_resources(kwargs, needs=None, prepared=None):
+    """Prepares the arguments of every enabled and needed resource
+
+    Prompts for any missing value, so it must run before fetching.
+    Resources in *prepared* plans reuse their arguments.
+    """
+    prepared = {plan.name: plan.args for plan in prepared or []}
+    plans = []
+    for name, prepare, fetch in get_resources():
+        used = resource_needs(name, needs)
+        if kwargs.get(name) and used != set():
+            args = prepared.get(name) or prepare(only_args_with(name + u'_', kwargs))
+            plans.append(resource_plan(name, fetch, args, used))
+    return plans
+
+
+def resource_needs(name, needs):
+    """Variables of resource *name* in *needs*. None means all of them"""
+    if needs is None:
+        return None
+    return needs.intersection(resource_variables[name])
+
+
+def wanted(needs, *names):
+    """Whether any of *names* is needed. None *needs* means all are"""
+    return needs is None or any(name in needs for name in names)
+
+
+def explain_resources(kwargs, needs):
+    """Prints which enabled resources are pruned and why"""
+    if not kwargs.get(u'template'):
+        click.echo(u'prune: No template given, nothing pruned', err=True)
+        return
+    if needs is None:
+        click.echo(u'prune: Template variables cannot be known, nothing pruned',
+                   err=True)
+        return
+
+    for name, _, _ in get_resources():
+        if not kwargs.get(name):
+            continue
+
+        used = resource_needs(name, needs)
+        unused = sorted(set(resource_variables[name]) - used)
+        if not used:
+            click.echo(u'{}: pruned, template uses none of {}'
+                       .format(name, u', '.join(unused)), err=True)
+        else:
+            click.echo(u'{}: fetched for {}{}'.format(
+                name, u', '.join(sorted(used)),
+                u'; unused ' + u', '.join(unused) if unused else u''), err=True)
+
+
+def get_template_needs(kwargs, templates=None):
+    """Variables the templates may use when pruning. None means any"""
+    templates = templates or [kwargs.get(u'template')]
+    if not kwargs.get(u'prune') or not all(templates):
+        return None
+
+    needs = set()
+    for template in templates:
+        template_vars = template_needs(template)
+        if template_vars is None:
+            return None
+        needs.update(template_vars)
+    return needs
+
+
+def template_needs(path, _seen=None):
+    """Undeclared variables of a template and the templates it references
+
+    Returns None if any referenced template cannot be found, as
+    its variables cannot be known in advance.
+    """
+    path = os.path.abspath(path)
+    seen = _seen if _seen is not None else set()
+    if path in seen:
+        return set()
+    seen.add(path)
+
+    with io.open(path, 'r', encoding='utf-8') as stream:
+        ast = get_template_environment(os.path.dirname(path)).parse(stream.read())
+
+    needs = jinja2.meta.find_undeclared_variables(ast)
+    for name in jinja2.meta.find_referenced_templates(ast):
+        referenced = name and os.path.join(os.path.dirname(path), name)
+        if not referenced or not os.path.isfile(referenced):
+            return None
+        referenced_needs = template_needs(referenced, seen)
+        if referenced_needs is None:
+            return None
+        needs.update(referenced_needs)
+
+    return needs
+
+
+def fetch_resources(plans, jobs=None, cache=None):
+    """Fetches planned resources concurrently
+
+    Returns the fetched data in plans order, so later resources keep
+    overriding previous ones. Fails reporting every failed resource.
+    """
+    results = parallel_map(functools.partial(fetch_resource, cache=cache),
+                           plans, jobs)
+
+    failures = [(plan, exception) for plan, (_, exception)
+                in zip(plans, results) if exception is not None]
+    if failures:
+        error(u'Could not fetch {} resource(s):\n{}'.format(len(failures), u'\n'.join(
+            u'  {}: {}'.format(plan.name, describe_exception(exception))
+            for plan, exception in failures)))
+
+    return [data for data, _ in results]
+
+
+def fetch_resource(plan, cache=None):
+    """Fetches a planned resource returning (data, exception)"""
+    try:
+        if cache is not None:
+            return needed_data(cache.fetch(plan), plan.needs), None
+        return needed_data(plan.fetch(needs=plan.needs, **plan.args), plan.needs), None
+    except Exception as exception:
+        return None, exception
+
+
+def needed_data(data, needs):
+    """Fetched *data* but the variables not in *needs*, when given
+
+    Leaves out live objects not used by the template, like api clients,
+    so a pruned context is plain data more often.
+    """
+    if needs is None:
+        return data
+    return {name: value for name, value in data.items() if name in needs}
+
+
+def get_resource_cache(kwargs):
+    """Resources cache under DICTO_HOME unless disabled"""
+    if kwargs.get(u'cache') is False:
+        return None
+
+    return ResourceCache(
+        os.path.join(get_dicto_home(), u'cache', u'resources'),
+        max_size=int(kwargs.get(u'cache_size') or 256) * 1024 * 1024,
+        ttls=kwargs.get(u'cache_ttl'),
+        refresh=kwargs.get(u'refresh'))
+
+
+def get_http_cache():
+    """Cache of HTTP responses to revalidate with the server"""
+    return Cache(os.path.join(get_dicto_home(), u'cache', u'http'),
+                 max_size=256 * 1024 * 1024)
+
+
+def get_redmine_cache():
+    """Cache of redmine servers indexes"""
+    return Cache(os.path.join(get_dicto_home(), u'cache', u'redmine'),
+                 max_size=64 * 1024 * 1024)
+
+
+def get_exe_cache(kwargs):
+    """Cache of --exe outputs under DICTO_HOME unless disabled"""
+    if kwargs.get(u'cache') is False:
+        return None
+    return Cache(os.path.join(get_dicto_home(), u'cache', u'exe'),
+                 max_size=64 * 1024 * 1024)
+
+
+def get_tags_cache():
+    """Cache of git repositories tags indexes"""
+    return Cache(os.path.join(get_dicto_home(), u'cache', u'tags'),
+                 max_size=64 * 1024 * 1024)
+
+
+def get_template_cache():
+    """Compiled templates, written by the jinja2 bytecode cache"""
+    cache = Cache(os.path.join(get_dicto_home(), u'cache', u'templates'))
+    cache.suffix = u'.cache'
+    return cache
+
+
+def get_caches():
+    return [get_resource_cache({}), get_http_cache(), get_redmine_cache(),
+            get_exe_cache({}), get_tags_cache(), get_template_cache()]
+
+
+class Cache(object):
+    """On-disk cache of pickled values with expiration and LRU eviction
+
+    Each entry is a file, touched when read, so the least recently used
+    ones are removed first when the cache grows over *max_size* bytes.
+    Hits and misses are counted by name and kept in a stats file.
+    """
+    suffix = u'.pickle'
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.counts = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+
+    def make_key(self, *parts):
+        data = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def entries(self):
+        """Paths of all cache entries"""
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, name) for name in os.listdir(self.path)
+                if name.endswith(self.suffix)]
+
+    def get(self, key, ttl=None):
+        """Value for *key*. None when missing or older than *ttl* seconds"""
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as stream:
+                created, value = pickle.load(stream)
+        except Exception:  # missing or corrupted entry
+            return None
+
+        if ttl is not None and time.time() - created > ttl:
+            return None
+
+        touch(path)
+        return value
+
+    def set(self, key, value):
+        atomic_write(self.entry_path(key),
+                     pickle.dumps((time.time(), value), protocol=2))
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries while over max size"""
+        if self.max_size is None:
+            return
+
+        with self.lock:
+            entries = sorted(self.entry_stats())
+            size = sum(size for _, size, _ in entries)
+            for _, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+                remove_file(path)
+                size -= entry_size
+
+    def entry_stats(self):
+        """(mtime, size, path) of the entries, but those removed meanwhile"""
+        for path in self.entries():
+            try:
+                yield os.path.getmtime(path), os.path.getsize(path), path
+            except OSError:  # removed by other process or thread
+                continue
+
+    def clear(self):
+        """Removes all entries and stats. Returns removed entries count"""
+        entries = self.entries()
+        for path in entries + [self.stats_path()]:
+            remove_file(path)
+        return len(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entry_stats())
+
+    def count(self, name, event):
+        with self.lock:
+            self.counts[name][event] += 1
+
+    def stats_path(self):
+        return os.path.join(self.path, u'stats.json')
+
+    def read_stats(self):
+        try:
+            with io.open(self.stats_path(), encoding='utf-8') as stream:
+                return json.load(stream)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_stats(self):
+        """Adds up this session counts to the stored stats"""
+        with self.lock:
+            if not self.counts:
+                return
+            stats = self.read_stats()
+            for name, counts in self.counts.items():
+                stored = stats.setdefault(name, {})
+                for event, value in counts.items():
+                    stored[event] = stored.get(event, 0) + value
+            self.counts.clear()
+
+        atomic_write(self.stats_path(), json.dumps(stats).encode('utf-8'))
+
+
+class ResourceCache(Cache):
+    """Cache of fetched resource data by resource name and arguments
+
+    Only plain data is stored, so live api clients are never written to
+    disk, and secret arguments are only keyed by their digest. Resources
+    that need live objects are fetched again every time.
+    """
+    default_ttl = 300
+
+    def __init__(self, path, max_size=None, ttls=None, refresh=False):
+        super(ResourceCache, self).__init__(path, max_size)
+        self.ttls = ttls or {}
+        self.refresh = refresh
+
+    def fetch(self, plan):
+        key = self.make_key(
+            plan.name,
+            {k: secret_digest(v) if is_secret(k) else v
+             for k, v in plan.args.items()},
+            sorted(plan.needs) if plan.needs is not None else None)
+        variables = resource_variables[plan.name] if plan.needs is None else plan.needs
+
+        if not self.refresh:
+            data = self.get(key, self.ttls.get(plan.name, self.default_ttl))
+            if data is not None and all(name in data for name in variables):
+                self.count(plan.name, u'hits')
+                return data
+
+        self.count(plan.name, u'misses')
+        data = plan.fetch(needs=plan.needs, **plan.args)
+
+        plain = {k: v for k, v in data.items() if is_plain_data(v)}
+        if all(name in plain for name in variables):
+            try:
+                self.set(key, plain)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                pass  # not stored, fetched again next time
+
+        return data
+
+
+def is_secret(name):
+    return u'password' in name or name.endswith(u'_key')
+
+
+def secret_digest(value):
+    """Stands for a secret in cache keys, so it is never hashed as given"""
+    if value is None:
+        return None
+    return hashlib.sha256(six.text_type(value).encode('utf-8')).hexdigest()
+
+
+def describe_exception(exception):
+    if isinstance(exception, click.ClickException):
+        return exception.message
+    return u'{}: {}'.format(type(exception).__name__, six.text_type(exception))
+
+
 def update_no_override(dst, src):
     """Sets src values in dst only if not valued in dst already"""
     dst.update({key: value for key, value in src.items() if dst.get(key) is None})
@@ -328,12 +998,28 @@ def get_profile(config, profile_name):
 
 
 def read_config(path):
+    import yaml
+
     context = dict(
         config=path,
         config_dir=os.path.dirname(path)
     )
 
-    return yaml.load(render_template(path, context)) or {}
+    # not cached, as configs may hold credentials
+    return yaml.load(render_template(path, context, cached=False)) or {}
+
+
+prompting = threading.local()
+
+
+@contextlib.contextmanager
+def without_prompts():
+    """Missing values are errors instead of prompts in this thread"""
+    prompting.disabled = True
+    try:
+        yield
+    finally:
+        prompting.disabled = False
 
 
 def prompt_for_missing_values(kwargs, required=None, mutual=None):
@@ -342,6 +1028,8 @@ def prompt_for_missing_values(kwargs, required=None, mutual=None):
 
     for key in required:
         if should_prompt_for_value(kwargs, mutual, key):
+            if getattr(prompting, 'disabled', False):
+                error(u'Missing value for ' + key.replace(u'_', u' '))
             kwargs[key] = click.prompt(
                 text=u'Enter ' + key.replace(u'_', u' '),
                 hide_input='password' in key
@@ -358,7 +1046,7 @@ def should_prompt_for_value(kwargs, mutual, key):
     return kwargs.get(key) is None and kwargs.get(mutual.get(key)) is None
 
 
-def get_redmine_data(kwargs):
+def prepare_redmine_args(kwargs):
     required = get_function_args(fetch_redmine_data)
     mutual = dict(
         redmine_user=u'redmine_key',
@@ -367,20 +1055,136 @@ def get_redmine_data(kwargs):
     )
     fill_optional_values(kwargs, mutual)
     prompt_for_missing_values(kwargs, required, mutual)
-    return fetch_redmine_data(**kwargs)
+    return kwargs
+
 
+def get_project_by_name(api, project_name, index=None):
+    """Project by identifier or case insensitive name
 
-def get_project_by_name(redmine, project_name):
-    return first(p for p in redmine.project.all()
-                 if p.name.lower() == project_name.lower())
+    Identifiers are looked up directly and names through the persistent
+    :class:`RedmineIndex` of the server, instead of listing all projects.
+    """
+    import redmine
+
+    if redmine_identifier.match(project_name):
+        try:
+            return api.project.get(project_name)
+        except (redmine.exceptions.ResourceNotFoundError,
+                redmine.exceptions.ForbiddenError):
+            pass  # may still be a project name
 
+    index = index or RedmineIndex(api)
+    project_id = index.project_id(project_name)
+    if project_id is None:
+        return None
 
-def get_version_by_name(project, version_name):
-    return first(v for v in project.versions if v.name == version_name)
+    try:
+        project = api.project.get(project_id)
+    except (redmine.exceptions.ResourceNotFoundError,
+            redmine.exceptions.ForbiddenError):
+        project = None  # deleted or hidden since it was indexed
+
+    if project is None or project.name.lower() != project_name.lower():
+        index.forget_project(project_id)
+        return None
+    return project
+
+
+def get_version_by_name(api, project, version_name, index=None):
+    """Version of *project* by name, through the :class:`RedmineIndex`"""
+    import redmine
+
+    index = index or RedmineIndex(api)
+    version_id = index.version_id(project.id, version_name)
+    if version_id is not None:
+        try:
+            version = api.version.get(version_id)
+            if version.name == version_name:
+                return version
+        except (redmine.exceptions.ResourceNotFoundError,
+                redmine.exceptions.ForbiddenError):
+            pass  # deleted or hidden since it was indexed
+
+    versions = list(api.version.filter(project_id=project.id))
+    index.set_versions(project.id, ((v.name, v.id) for v in versions))
+    return first(v for v in versions if v.name == version_name)
+
+
+redmine_identifier = re.compile(r'^[a-z][a-z0-9_\-]*$')
+
+
+class RedmineIndex(object):
+    """Project and version ids by name of a Redmine server
+
+    Kept between runs in the cache. Projects are refreshed on every
+    lookup asking only for the ones updated since the last refresh.
+    Versions are refreshed when a name is not found.
+    """
+    page_size = 100
+
+    def __init__(self, api, cache=None):
+        self.api = api
+        self.cache = cache or get_redmine_cache()
+        self.key = self.cache.make_key(api.url)
+        self.data = self.cache.get(self.key) or dict(
+            updated_on=None, projects={}, versions={})
+        self.refreshed = False
+
+    def project_id(self, name):
+        if not self.refreshed:
+            self.refresh_projects()
+        return self.data[u'projects'].get(name.lower())
+
+    def refresh_projects(self):
+        """Indexes the projects updated since the last refresh"""
+        params = dict(limit=self.page_size, offset=0)
+        if self.data[u'updated_on']:
+            params[u'updated_on'] = u'>=' + self.data[u'updated_on']
+
+        while True:
+            page = self.api.request(u'get', self.api.url + u'/projects.json',
+                                    params=dict(params))
+            for project in page[u'projects']:
+                self.set_project(project[u'name'], project[u'id'])
+                self.data[u'updated_on'] = max(self.data[u'updated_on'] or u'',
+                                               project.get(u'updated_on', u''))
+            params[u'offset'] += self.page_size
+            if params[u'offset'] >= page.get(u'total_count', 0):
+                break
+
+        self.refreshed = True
+        self.save()
+
+    def set_project(self, name, project_id):
+        self.forget_names(project_id)  # renamed projects
+        self.data[u'projects'][name.lower()] = project_id
+
+    def forget_project(self, project_id):
+        self.forget_names(project_id)
+        self.data[u'versions'].pop(six.text_type(project_id), None)
+        self.save()
+
+    def forget_names(self, project_id):
+        projects = self.data[u'projects']
+        for name in [n for n, i in projects.items() if i == project_id]:
+            del projects[name]
+
+    def version_id(self, project_id, name):
+        return self.data[u'versions'].get(six.text_type(project_id), {}).get(name)
+
+    def set_versions(self, project_id, versions):
+        self.data[u'versions'][six.text_type(project_id)] = dict(versions)
+        self.save()
+
+    def save(self):
+        self.cache.set(self.key, self.data)
 
 
 def fetch_redmine_data(redmine_url, redmine_project, redmine_version,
-                       redmine_user, redmine_password, redmine_key):
+                       redmine_user, redmine_password, redmine_key,
+                       redmine_bulk=None, redmine_jobs=None, redmine_include=None,
+                       redmine_fields=None, redmine_prefetch=None, redmine_store=None,
+                       needs=None):
     """Return a dict of redmine data resources
 
     :param redmine_url: Redmine access http/s url
@@ -390,6 +1194,16 @@ def fetch_redmine_data(redmine_url, redmine_project, redmine_version,
     :param redmine_password: Password for ``redmine_user``
     :param redmine_key: User's auth token (alternative to
                         ``redmine_user`` and ``redmine_password``)
+    :param redmine_bulk: Get issues as plain dicts with
+                         :func:`fetch_redmine_issues`
+    :param redmine_jobs: Issue pages to get at the same time in bulk mode
+    :param redmine_include: Issue associations to include in bulk mode
+    :param redmine_fields: Issue fields to keep in bulk mode
+    :param redmine_prefetch: Issue attributes to get for all issues at
+                             once, see :func:`prefetch_redmine_issues`
+    :param redmine_store: Get issues as plain dicts from a local
+                          :class:`RedmineStore`, synced before
+    :param needs: Set of context variables to fetch. Defaults to all.
 
     :returns: Context dict populated with the following data:
       - redmine_api: Object for redmine at *redmine_url*
@@ -398,23 +1212,50 @@ def fetch_redmine_data(redmine_url, redmine_project, redmine_version,
       - redmine_issues: List of objects for open issues in *redmine_project*
         at *redmine_version*
     """
+    import redmine
+
     api = redmine.Redmine(redmine_url, username=redmine_user,
                           password=redmine_password, key=redmine_key)
 
-    project = get_project_by_name(api, redmine_project)
-    if project is None:
-        error(u'redmine: Project "{}" not found'.format(redmine_project))
+    index = RedmineIndex(api)
+    project = version = issues = None
 
-    version = get_version_by_name(project, redmine_version)
-    if version is None:
-        error(u'redmine: Project "{}" has no version "{}"'
-              .format(redmine_project, redmine_version))
+    if wanted(needs, u'redmine_project', u'redmine_version', u'redmine_issues'):
+        project = get_project_by_name(api, redmine_project, index)
+        if project is None:
+            error(u'redmine: Project "{}" not found'.format(redmine_project))
 
-    issues = api.issue.filter(
-        project_id=project.id,
-        fixed_version_id=version.id,
-        status_id='closed'
-    )
+    if wanted(needs, u'redmine_version', u'redmine_issues'):
+        version = get_version_by_name(api, project, redmine_version, index)
+        if version is None:
+            error(u'redmine: Project "{}" has no version "{}"'
+                  .format(redmine_project, redmine_version))
+
+    if wanted(needs, u'redmine_issues') and redmine_store:
+        store = RedmineStore(api)
+        try:
+            store.sync(project.id, redmine_jobs)
+            issues = [compact_redmine_issue(issue, redmine_fields)
+                      for issue in store.issues(project.id, version.id, closed=True)]
+        finally:
+            store.close()
+    elif wanted(needs, u'redmine_issues') and redmine_bulk:
+        issues = fetch_redmine_issues(
+            api, dict(project_id=project.id, fixed_version_id=version.id,
+                      status_id=u'closed'),
+            redmine_jobs, redmine_include, redmine_fields)
+    elif wanted(needs, u'redmine_issues'):
+        issues = api.issue.filter(
+            project_id=project.id,
+            fixed_version_id=version.id,
+            status_id='closed'
+        )
+
+    if issues is not None and redmine_prefetch:
+        issues = list(issues)
+        plain = redmine_bulk or redmine_store
+        records = issues if plain else [issue._attributes for issue in issues]
+        prefetch_redmine_issues(api, records, redmine_prefetch, redmine_jobs)
 
     return dict(
         redmine_api=api,
@@ -424,52 +1265,877 @@ def fetch_redmine_data(redmine_url, redmine_project, redmine_version,
     )
 
 
+def fetch_redmine_issues(api, filters, jobs=None, include=None, fields=None):
+    """Issues matching *filters* as a list of plain dicts
+
+    Reads the first page to get the issues count and then the rest of
+    pages, up to *jobs* (default: 4) at the same time, over keep-alive
+    connections. Issues have the *include* associations and only the
+    given *fields*, if any. Values are left as the API returns them, so
+    dates are strings and associations are dicts.
+    """
+    jobs = jobs or 4
+    params = dict(filters, limit=redmine_page_size, sort=u'id')
+    if include:
+        params[u'include'] = u','.join(include)
+
+    with contextlib.closing(make_redmine_session(api, jobs)) as session:
+        def get_page(offset):
+            response = session.get(api.url + u'/issues.json',
+                                   params=dict(params, offset=offset))
+            if response.status_code != 200:
+                error(u'redmine: Could not get issues from {}: HTTP {}'
+                      .format(api.url, response.status_code))
+            return response.json()
+
+        page = get_page(0)
+        offsets = range(redmine_page_size, page.get(u'total_count', 0),
+                        redmine_page_size)
+        pages = [page] + parallel_map(get_page, offsets, jobs)
+
+    issues = collections.OrderedDict()  # pages may overlap on changes
+    for page in pages:
+        for issue in page[u'issues']:
+            issues[issue[u'id']] = compact_redmine_issue(issue, fields)
+    return list(issues.values())
+
+
+redmine_page_size = 100  # max page size of the Redmine API
+
+
+def make_redmine_session(api, pool_size):
+    """HTTP session authenticated as the user of *api*"""
+    session = make_http_session(pool_size)
+    if api.key:
+        session.headers[u'X-Redmine-API-Key'] = api.key
+    else:
+        session.auth = (api.username, api.password)
+    return session
+
+
+def prefetch_redmine_issues(api, issues, names, jobs=None):
+    """Adds the *names* attributes to all the *issues* dicts at once
+
+    Instead of a request by issue and attribute when templates use them,
+    ``journals`` and ``relations`` are asked for many issues in each
+    request, through the ``issue_id`` filter, and each ``assigned_to``
+    user once. Servers that do not include journals in issue lists are
+    asked by issue, concurrently. Prints the requests saved.
+    """
+    requests = lazy_requests = 0
+
+    with contextlib.closing(make_redmine_session(api, jobs or 4)) as session:
+        def get(path, params=None):
+            response = session.get(api.url + path, params=params)
+            if response.status_code != 200:
+                error(u'redmine: Could not prefetch {} from {}: HTTP {}'
+                      .format(path, api.url, response.status_code))
+            return response.json()
+
+        def get_includes(ids):
+            return get(u'/issues.json', dict(
+                issue_id=u','.join(map(six.text_type, ids)), status_id=u'*',
+                include=u','.join(includes), limit=len(ids)))[u'issues']
+
+        includes = [name for name in (u'journals', u'relations') if name in names]
+        if includes:
+            ids = [issue[u'id'] for issue in issues]
+            chunks = [ids[i:i + redmine_page_size]
+                      for i in range(0, len(ids), redmine_page_size)]
+            fetched = {issue[u'id']: issue for chunk in parallel_map(get_includes, chunks, jobs)
+                       for issue in chunk}
+            requests += len(chunks)
+
+            for name in includes:
+                missing = [issue for issue in issues
+                           if name not in fetched.get(issue[u'id'], {})]
+                requests += len(missing)
+                lazy_requests += len(issues)
+                for issue in issues:
+                    issue[name] = fetched.get(issue[u'id'], {}).get(name, [])
+                parallel_map(lambda issue: issue.update(
+                    {name: get(u'/issues/{}.json'.format(issue[u'id']),
+                               dict(include=name))[u'issue'].get(name, [])}),
+                    missing, jobs)
+
+        if u'assigned_to' in names:
+            assigned = [issue for issue in issues if issue.get(u'assigned_to')]
+            user_ids = sorted(set(issue[u'assigned_to'][u'id'] for issue in assigned))
+            users = dict(zip(user_ids, parallel_map(
+                lambda user_id: get(u'/users/{}.json'.format(user_id))[u'user'],
+                user_ids, jobs)))
+            for issue in assigned:
+                issue[u'assigned_to'] = users[issue[u'assigned_to'][u'id']]
+            requests += len(user_ids)
+            lazy_requests += len(assigned)
+
+    click.echo(u'redmine: prefetched {} for {} issues in {} requests, {} saved'.format(
+        u', '.join(names), len(issues), requests,
+        max(lazy_requests - requests, 0)), err=True)
+
+
+class RedmineStore(object):
+    """Local SQLite copy of the issues of a Redmine server
+
+    Each sync asks only for the project issues updated since the last
+    one, and saves them along with the new sync time in a single
+    transaction, so an interrupted sync leaves the store as it was.
+    Issues updated while syncing may be missed by the pages already
+    read, so the next sync asks again for those updated as long before
+    the latest one as the sync took.
+    Issues are kept by synced project, including its subprojects ones
+    as Redmine does. Issues deleted or moved to other projects in Redmine
+    are kept.
+    """
+    schema = u'''
+        CREATE TABLE IF NOT EXISTS issues (
+            id INTEGER PRIMARY KEY, project_id INTEGER, fixed_version_id INTEGER,
+            status_id INTEGER, updated_on TEXT, data TEXT);
+        CREATE INDEX IF NOT EXISTS issues_version ON issues (project_id, fixed_version_id);
+        CREATE TABLE IF NOT EXISTS statuses (
+            id INTEGER PRIMARY KEY, name TEXT, is_closed INTEGER);
+        CREATE TABLE IF NOT EXISTS syncs (
+            project_id INTEGER PRIMARY KEY, last_sync TEXT);
+    '''
+
+    def __init__(self, api, path=None):
+        import sqlite3
+
+        self.api = api
+        self.path = path or os.path.join(
+            get_dicto_home(), u'stores', u'redmine',
+            hashlib.sha1(api.url.encode('utf-8')).hexdigest() + u'.sqlite')
+        make_dirs(os.path.dirname(self.path))
+
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    def last_sync(self, project_id):
+        row = self.db.execute(u'SELECT last_sync FROM syncs WHERE project_id = ?',
+                              (project_id,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, project_id, jobs=None):
+        """Gets the project issues updated since the last sync"""
+        last_sync = self.last_sync(project_id)
+        filters = dict(project_id=project_id, status_id=u'*')
+        if last_sync:
+            filters[u'updated_on'] = u'>=' + last_sync
+
+        started = time.time()
+        issues = fetch_redmine_issues(self.api, filters, jobs)
+        overlap = time.time() - started
+        if self.unknown_statuses(issues):
+            statuses = self.api.request(u'get', self.api.url + u'/issue_statuses.json')
+            self.update_statuses(statuses[u'issue_statuses'])
+        self.update(project_id, issues, overlap)
+
+    def unknown_statuses(self, issues):
+        known = set(row[0] for row in self.db.execute(u'SELECT id FROM statuses'))
+        return set(issue[u'status'][u'id'] for issue in issues) - known
+
+    def update_statuses(self, statuses):
+        with self.db:
+            self.db.executemany(
+                u'INSERT OR REPLACE INTO statuses VALUES (?, ?, ?)',
+                ((s[u'id'], s[u'name'], bool(s.get(u'is_closed'))) for s in statuses))
+
+    def update(self, project_id, issues, overlap=0):
+        """Saves *issues* and advances the last sync, all or nothing
+
+        The last sync is the latest issue update but *overlap* seconds.
+        """
+        last_sync, latest = self.last_sync(project_id), None
+        with self.db:
+            for issue in issues:
+                self.db.execute(
+                    u'INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?)',
+                    (issue[u'id'], project_id,
+                     (issue.get(u'fixed_version') or {}).get(u'id'),
+                     issue[u'status'][u'id'], issue[u'updated_on'], json.dumps(issue)))
+                latest = max(latest or u'', issue[u'updated_on'])
+            if latest:
+                last_sync = max(last_sync or u'', redmine_time_before(latest, overlap))
+            self.db.execute(u'INSERT OR REPLACE INTO syncs VALUES (?, ?)',
+                            (project_id, last_sync))
+
+    def issues(self, project_id, version_id, closed=None):
+        """Issues of a project version, optionally only closed or open ones"""
+        query = (u'SELECT data FROM issues LEFT JOIN statuses ON status_id = statuses.id '
+                 u'WHERE project_id = ? AND fixed_version_id = ?')
+        params = [project_id, version_id]
+        if closed is not None:
+            query += u' AND coalesce(is_closed, 0) = ?'
+            params.append(closed)
+        return [json.loads(row[0])
+                for row in self.db.execute(query + u' ORDER BY issues.id', params)]
+
+
+def redmine_time_before(value, seconds):
+    """Redmine API timestamp *value* at least *seconds* earlier"""
+    if not seconds:
+        return value
+    try:
+        moment = datetime.datetime.strptime(value, u'%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:  # not as the JSON API formats it
+        return value
+    moment -= datetime.timedelta(seconds=int(seconds) + 1)
+    return moment.strftime(u'%Y-%m-%dT%H:%M:%SZ')
+
+
+def compact_redmine_issue(issue, fields=None):
+    if not fields:
+        return issue
+    return {key: value for key, value in issue.items()
+            if key in fields or key == u'id'}
+
+
+output_buffer_size = 64 * 1024
+
+
 def write_output(content, output=None, append=None, prepend=None):
     """Writes content to stdout or a file optionally appending/prepending
 
     Writes a separation endline between content and previous file contents.
     Only one file (output, append, prepend) can be given at a time.
 
-    :param content: Unicode to write to the output
+    :param content: Unicode or iterable of unicode chunks to write.
+        Chunks are written as they come, a buffer at a time.
     :param output: Open file for writing.
     :param append: Open file for appending.
-    :param prepend: Open file for reading and writing.
+    :param prepend: Path of the file to prepend to. The new file is
+        written aside and replaces the old one once complete.
     """
-    file = output or append or prepend
+    file = output or append
+    if isinstance(content, six.string_types):
+        content = [content]
 
     # Append to current file
     if append:
-        content = u'\n' + content
+        content = itertools.chain([u'\n'], content)
 
     # Prepend to current file
     if prepend:
-        content += u'\n' + file.read()  # read current file contents
-        file.seek(0)                    # write again from the beginning
+        return prepend_output(content, prepend)
+
+    for chunk in buffer_chunks(content, output_buffer_size):
+        click.echo(chunk, file=file, nl=False)
+
+    if not file:
+        click.echo(u'')
+
+
+def prepend_output(content, path):
+    """Writes unicode chunks and then the current contents of *path*
+
+    Old contents are copied a buffer at a time into a new file, which is
+    synced and renamed over *path*, so it is never left half written.
+    """
+    path = os.path.realpath(path)
+    with atomic_file(path, sync=True) as stream:
+        for chunk in buffer_chunks(content, output_buffer_size):
+            stream.write(chunk.encode('utf-8'))
+        stream.write(b'\n')
+
+        with open(path, 'rb') as previous:
+            shutil.copyfileobj(previous, stream, output_buffer_size)
+
+
+def buffer_chunks(chunks, size):
+    """Joins unicode *chunks* into chunks of at least *size* characters"""
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield u''.join(buffer)
+            buffer, length = [], 0
+
+    if buffer:
+        yield u''.join(buffer)
+
+
+# named as the module attribute, so forked renders can send it back
+render_target = collections.namedtuple(
+    u'render_target', [u'template', u'output', u'mode'])
+
+
+def read_manifest(path):
+    """Render targets of a manifest file with paths relative to it"""
+    import yaml
 
-    click.echo(content, file=file, nl=not file)
+    with io.open(path, encoding='utf-8') as stream:
+        entries = yaml.safe_load(stream)
+    if not isinstance(entries, list):
+        error(u'Manifest {} must be a list of targets'.format(click.format_filename(path)))
 
+    directory = os.path.dirname(path)
+    targets = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get(u'template'):
+            error(u'Manifest target without template: {!r}'.format(entry))
+
+        mode = entry.get(u'mode', u'write')
+        if mode not in render_modes:
+            error(u'Unknown mode {} for template {}, use one of: {}'.format(
+                mode, entry[u'template'], u', '.join(render_modes)))
+
+        output = entry.get(u'output')
+        targets.append(render_target(os.path.join(directory, entry[u'template']),
+                                     output and os.path.join(directory, output), mode))
+    return targets
+
+
+def render_targets(targets, context, jobs=None):
+    """Renders and writes targets, at the same time when possible
+
+    Targets writing to the same output are rendered in manifest order.
+    Contexts with resource objects are rendered serially, as these may
+    not be safe to use from many threads. Fails reporting every failed
+    target.
+    """
+    outputs = collections.OrderedDict()
+    for target in targets:
+        outputs.setdefault(target.output, []).append(target)
+    if not is_plain_data(context):
+        jobs = 1
+
+    results = parallel_map(functools.partial(render_output_targets, context=context),
+                           outputs.values(), jobs)
+
+    report_render_failures(results)
+
+
+def render_profiles(targets, contexts, jobs=None):
+    """Renders each target with its context at the same time when possible
+
+    Targets are rendered in forked processes, which inherit the contexts
+    instead of receiving a copy. Where processes cannot be forked threads
+    are used instead. Contexts with resource objects are rendered
+    serially, as these may not be safe to use from many threads or
+    processes. Fails reporting every failed target.
+    """
+    renders = list(zip(targets, contexts))
+    if not all(is_plain_data(context) for context in contexts):
+        jobs = 1
+
+    jobs = min(jobs or cpu_count(), len(renders))
+    pool = None
+    if jobs > 1:
+        forked_renders[:] = renders  # set before forking the processes
+        pool = make_fork_pool(jobs)
 
-def render_template(path, context):
     try:
-        return make_template(path).render(context)
+        if pool is None:
+            results = parallel_map(render_pair, renders, jobs)
+        else:
+            results = pool.map(render_forked, range(len(renders)))
+    finally:
+        del forked_renders[:]
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report_render_failures(results)
+
+
+forked_renders = []
+
+
+def render_forked(index):
+    return render_pair(forked_renders[index])
+
+
+def render_pair(render):
+    target, context = render
+    return render_output_targets([target], context)
+
+
+def make_fork_pool(processes):
+    """Pool of forked processes, None where processes cannot be forked"""
+    import multiprocessing
+
+    if not hasattr(os, 'fork'):
+        return None
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(processes)
+    return multiprocessing.Pool(processes)
+
+
+def cpu_count():
+    import multiprocessing
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def render_output_targets(targets, context):
+    """Writes targets in order returning failures as (target, message)"""
+    failures = []
+    for target in targets:
+        try:
+            write_target(target, context)
+        except Exception as exception:
+            failures.append((target, describe_exception(exception)))
+    return failures
+
+
+def report_render_failures(results):
+    failures = [failure for output_failures in results for failure in output_failures]
+    if failures:
+        error(u'Could not render {} target(s):\n{}'.format(len(failures), u'\n'.join(
+            u'  {} into {}: {}'.format(target.template, target.output or u'stdout', message)
+            for target, message in failures)))
+
+
+class RenderService(object):
+    """Renders templates on request keeping config and resources warm
+
+    The config file is read again only when it changes, and fetched
+    resources are reused while fresher than their ``cache_ttl``, so
+    live clients in them are reused too, and forgotten once expired. Identical fetches requested at
+    the same time are made once, the rest waiting for its result.
+    """
+    def __init__(self, config_path, kwargs):
+        self.config_path = config_path
+        self.kwargs = kwargs
+        self.config, self.config_mtime = {}, None
+        self.ttls = {}
+        self.resources = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.metrics = collections.Counter()
+        self.started = time.time()
+
+    def get_config(self):
+        mtime = os.path.getmtime(self.config_path) if self.config_path else None
+        with self.lock:
+            if mtime != self.config_mtime:
+                self.config, self.config_mtime = read_config(self.config_path), mtime
+                self.ttls = resolve_args(copy.deepcopy(self.config), dict(self.kwargs)) \
+                    .get(u'cache_ttl') or {}
+                self.metrics[u'config_reads'] += 1
+            return self.config
+
+    def render(self, profile=None, data=None):
+        """Renders the template of *profile* as unicode"""
+        self.count(u'renders')
+        start = time.time()
+        try:
+            check_request_data(data, self.kwargs)
+            kwargs = resolve_args(copy.deepcopy(self.get_config()),
+                                  dict(self.kwargs, profile=profile))
+            kwargs[u'data'] = dict(kwargs.get(u'data') or {})
+            kwargs[u'data'].update(data or {})
+
+            with without_prompts():
+                context, plans = plan_context(kwargs)
+            context = update_context(context, fetch_resources(plans, kwargs.get(u'jobs'), self))
+            template = kwargs.get(u'template') or error(u'No template given')
+
+            if is_plain_data(context):
+                return render_template(template, context)
+            with self.render_lock:  # resource objects are not thread safe
+                return render_template(template, context)
+        except Exception:
+            self.count(u'render_errors')
+            raise
+        finally:
+            self.count(u'render_seconds', time.time() - start)
+
+    def fetch(self, plan):
+        """Fetched data of a plan, fresh or coalesced with a running fetch"""
+        key = plan_key(plan)
+        ttl = self.ttls.get(plan.name, ResourceCache.default_ttl)
+        with self.lock:
+            self.remove_expired()
+            fetched = self.resources.get(key)
+            if fetched is not None:
+                self.metrics[plan.name + u'_hits'] += 1
+                return fetched[1]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            self.metrics[plan.name + (u'_fetches' if leader else u'_coalesced')] += 1
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            data = plan.fetch(needs=plan.needs, **plan.args)
+            with self.lock:
+                self.resources[key] = time.time() + ttl, data
+            flight.set(data)
+            return data
+        except BaseException as exception:
+            flight.set(exception=exception)
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+    def remove_expired(self):
+        """Forgets resources older than their ttl. Called holding the lock"""
+        now = time.time()
+        for key in [key for key, (expires, _) in self.resources.items() if expires <= now]:
+            del self.resources[key]
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.metrics[name] += value
+
+    def health(self):
+        return dict(status=u'ok', uptime=time.time() - self.started)
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, resources=len(self.resources),
+                        fetching=len(self.flights), uptime=time.time() - self.started)
+
+
+def check_request_data(data, kwargs):
+    """Fails on request *data* naming options or resource arguments
+
+    Data values are also taken as options not set otherwise, see
+    :func:`plan_context`, so clients could set the template or where
+    resources and their credentials are sent to.
+    """
+    resources = tuple(name for name, _, _ in get_resources())
+    options = sorted(name for name in data or {} if name in kwargs or name in resources
+                     or name.startswith(tuple(r + u'_' for r in resources)))
+    if options:
+        error(u'Request data cannot set options: ' + u', '.join(options))
+
+
+class Flight(object):
+    """Result of a call other threads can wait for"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = self.exception = None
+
+    def set(self, data=None, exception=None):
+        self.data, self.exception = data, exception
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.data
+
+
+def make_render_server(service, host=u'127.0.0.1', port=0):
+    """Threaded HTTP server answering requests with a RenderService"""
+    from six.moves import BaseHTTPServer, socketserver
+    from six.moves.urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            service.count(u'requests')
+
+            if url.path == u'/health':
+                return self.respond(200, json.dumps(service.health()), u'application/json')
+            if url.path == u'/metrics':
+                return self.respond(200, json.dumps(service.get_metrics()), u'application/json')
+            if url.path != u'/view':
+                return self.respond(404, u'Not found: ' + url.path)
+
+            try:
+                content = service.render(first(query.get(u'profile', [])),
+                                         _parse_option_list(query.get(u'data')))
+            except Exception as exception:
+                return self.respond(500, describe_exception(exception))
+            self.respond(200, content)
+
+        def respond(self, status, content, content_type=u'text/plain'):
+            body = content.encode('utf-8')
+            self.send_response(status)
+            self.send_header(u'Content-Type', content_type + u'; charset=utf-8')
+            self.send_header(u'Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            click.echo(u'{} {}'.format(self.address_string(), format % args), err=True)
+
+    class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    return Server((host, port), Handler)
+
+
+class WatchedContext(object):
+    """Template context kept in memory and updated as its inputs change
+
+    Inputs are the config file, the template and the templates it
+    references, the --file paths and the refs of a local git
+    repository. Only what changed inputs feed is read or fetched again.
+    """
+    def __init__(self, config_path, kwargs, file_paths=None, explain=False):
+        self.config_path = config_path
+        self.cli_kwargs = kwargs
+        self.file_paths = file_paths or {}
+        self.explain = explain
+        self.load()
+
+    def load(self):
+        """Reads the config and fetches every resource"""
+        config = read_config(self.config_path) if self.config_path else {}
+        kwargs = resolve_args(config, dict(self.cli_kwargs))
+        if self.explain:
+            kwargs[u'prune'] = True
+
+        base, plans = plan_context(kwargs, self.explain)
+        fetched = dict(zip([plan_key(plan) for plan in plans], fetch_plans(plans, kwargs)))
+        self.kwargs, self.base, self.plans, self.fetched = kwargs, base, plans, fetched
+
+    def update(self, kinds):
+        """Reads or fetches again the data of changed *kinds* of input"""
+        if u'config' in kinds:
+            return self.load()
+
+        if u'file' in kinds:
+            for name, path in self.file_paths.items():
+                with io.open(path, encoding='utf-8') as stream:
+                    self.base[name] = self.kwargs[u'file'][name] = stream.read().strip()
+
+        if u'template' in kinds and self.kwargs.get(u'prune'):
+            plans = plan_resources(self.kwargs, get_template_needs(self.kwargs), self.plans)
+            missing = [plan for plan in plans if plan_key(plan) not in self.fetched]
+            self.fetched.update(zip([plan_key(plan) for plan in missing],
+                                    fetch_plans(missing, self.kwargs)))
+            self.plans = plans
+
+        if u'git' in kinds:  # bypassing the resources cache
+            plans = [plan for plan in self.plans if plan.name == u'git']
+            self.fetched.update(zip([plan_key(plan) for plan in plans],
+                                    fetch_resources(plans, self.kwargs.get(u'jobs'))))
+
+    def context(self):
+        return update_context(dict(self.base), [self.fetched[plan_key(plan)]
+                                                for plan in self.plans])
+
+    def sources(self):
+        """Input paths to watch and the kind of input they are"""
+        sources = {}
+        if self.config_path:
+            sources[os.path.abspath(self.config_path)] = u'config'
+
+        if self.kwargs.get(u'template'):
+            for path in template_files(self.kwargs[u'template']):
+                sources[path] = u'template'
+
+        for path in self.file_paths.values():
+            sources[path] = u'file'
+
+        git_repo = self.kwargs.get(u'git_repo')
+        if self.kwargs.get(u'git') and git_repo and os.path.isdir(git_repo):
+            git_dir = os.path.join(os.path.abspath(git_repo), u'.git')
+            if not os.path.isdir(git_dir):
+                git_dir = os.path.abspath(git_repo)  # bare repository
+            for name in (u'HEAD', u'refs', u'packed-refs'):
+                sources[os.path.join(git_dir, name)] = u'git'
+
+        return sources
+
+
+def template_files(path, _seen=None):
+    """Paths of a template and the existing templates it references"""
+    path = os.path.abspath(path)
+    seen = _seen if _seen is not None else set()
+    if path in seen or not os.path.isfile(path):
+        return seen
+    seen.add(path)
+
+    with io.open(path, 'r', encoding='utf-8') as stream:
+        try:
+            ast = get_template_environment(os.path.dirname(path)).parse(stream.read())
+        except jinja2.TemplateSyntaxError:
+            return seen  # being edited
+
+    for name in jinja2.meta.find_referenced_templates(ast):
+        if name:
+            template_files(os.path.join(os.path.dirname(path), name), seen)
+    return seen
+
+
+watch_interval = 0.5
+
+
+def iter_changes(paths, interval=watch_interval):
+    """Yields the sets of *paths* changed since the previous one
+
+    Directories change when anything under them does. Changes within
+    *interval* seconds are yielded together. Uses watchdog file system
+    events when installed, polling the paths every *interval* otherwise.
+    """
+    try:
+        importlib.import_module(u'watchdog.observers')
+    except ImportError:
+        return iter_polled_changes(paths, interval)
+    return iter_watched_changes(paths, interval)
+
+
+def iter_polled_changes(paths, interval=watch_interval):
+    snapshots = {path: path_snapshot(path) for path in paths}
+
+    def changes():
+        while True:
+            time.sleep(interval)
+            changed = set()
+            for path in snapshots:
+                snapshot = path_snapshot(path)
+                if snapshot != snapshots[path]:
+                    snapshots[path] = snapshot
+                    changed.add(path)
+            if changed:
+                yield changed
+
+    return changes()
+
+
+def path_snapshot(path):
+    """Modification times and sizes of a file or the files in a directory"""
+    if not os.path.isdir(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime, stat.st_size
+        except OSError:
+            return None
+
+    snapshot = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        snapshot.extend((os.path.join(root, name), path_snapshot(os.path.join(root, name)))
+                        for name in sorted(files))
+    return snapshot
+
+
+def iter_watched_changes(paths, interval=watch_interval):
+    import watchdog.events
+    import watchdog.observers
+    from six.moves import queue
+
+    paths = list(paths)
+    events = queue.Queue()
+
+    class Handler(watchdog.events.FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.event_type in (u'opened', u'closed_no_write'):
+                return  # read, as when rendering
+            for changed in (event.src_path, getattr(event, 'dest_path', None)):
+                for path in paths:
+                    if changed and (changed == path or changed.startswith(path + os.sep)):
+                        events.put(path)
+
+    observer = watchdog.observers.Observer()
+    directories = set(path if os.path.isdir(path) else os.path.dirname(path)
+                      for path in paths)
+    for directory in filter(os.path.isdir, directories):
+        observer.schedule(Handler(), directory, recursive=directory in paths)
+    observer.start()
+
+    def changes():
+        try:
+            while True:
+                try:
+                    changed = set([events.get(timeout=interval)])
+                except queue.Empty:
+                    continue
+                time.sleep(interval)
+                while not events.empty():
+                    changed.add(events.get())
+                yield changed
+        finally:
+            observer.stop()
+            observer.join()
+
+    return changes()
+
+
+def write_target(target, context):
+    content = stream_template(target.template, context)
+    if target.output is None:
+        write_output(content)
+    elif target.mode == u'prepend':
+        write_output(content, prepend=target.output)
+    elif target.mode == u'append':
+        with io.open(target.output, 'a', encoding='utf-8') as stream:
+            write_output(content, append=stream)
+    else:
+        with io.open(target.output, 'w', encoding='utf-8') as stream:
+            write_output(content, output=stream)
+
+
+def render_template(path, context, cached=True):
+    return u''.join(stream_template(path, context, cached))
+
+
+def stream_template(path, context, cached=True):
+    """Renders the template at *path* as an iterator of unicode chunks
+
+    The document is never held in memory as a whole. Template errors
+    raised while rendering end the iteration with an error.
+    """
+    try:
+        for chunk in make_template(path, cached).generate(context):
+            yield chunk
     except jinja2.TemplateError as e:
         # TODO: Only show this on verbose mode
         print(traceback.print_exc())
         error(six.text_type(e) + u' in template ' + click.format_filename(path))
 
 
-def make_template(path):
-    with io.open(os.path.abspath(path), 'r', encoding='utf-8') as stream:
-        return jinja2.Template(stream.read())
+def make_template(path, cached=True):
+    path = os.path.abspath(path)
+    environment = get_template_environment(os.path.dirname(path), cached)
+    return environment.get_template(os.path.basename(path))
+
 
+template_environments = {}
+template_environments_lock = threading.Lock()
 
-def get_hg_data(hg_config):
+
+def get_template_environment(directory, cached=True):
+    """Shared jinja2 environment for the templates in *directory*
+
+    Templates can include or extend others relative to *directory*.
+    Compiled templates are kept under DICTO_HOME, so they are only
+    compiled again when their source changes, unless not *cached*.
+    """
+    path = get_template_cache().path if cached else None
+    with template_environments_lock:
+        environment = template_environments.get((directory, path))
+        if environment is None:
+            bytecode_cache = None
+            if cached:
+                make_dirs(path)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(path)
+            environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(directory),
+                bytecode_cache=bytecode_cache)
+            template_environments[directory, path] = environment
+        return environment
+
+
+def prepare_hg_args(hg_config):
     required = get_function_args(fetch_hg_data)
     prompt_for_missing_values(hg_config, required)
-    return fetch_hg_data(**hg_config)
+    return hg_config
 
 
-hg_tag = collections.namedtuple(u'Tag', [u'name', u'rev', u'node', u'islocal'])
+# named as the module attribute, so it can be pickled into the cache
+hg_tag = collections.namedtuple(u'hg_tag', [u'name', u'rev', u'node', u'islocal'])
 
 
 def make_hg_tag(*args):
@@ -479,12 +2145,14 @@ def make_hg_tag(*args):
 @contextlib.contextmanager
 def hg_tmp_clone(hg_repo):
     """Clone repository in a temporary path"""
+    import hglib
+
     try:
         hg_tmp_path = u''
         hg_repo_path = hg_repo
 
         # clone remote repositories into a temporal directory
-        if hg_repo.startswith(u'http') or hg_repo.startswith(u'ssh'):
+        if is_remote_repo(hg_repo):
             hg_tmp_path = hg_repo_path = tempfile.mkdtemp(prefix='dicto-hg')
             try:
                 hglib.clone(hg_repo, hg_repo_path)
@@ -499,28 +2167,173 @@ def hg_tmp_clone(hg_repo):
             shutil.rmtree(hg_tmp_path)
 
 
+def is_remote_repo(repo):
+    return repo.startswith(u'http') or repo.startswith(u'ssh')
+
+
+def get_hg_mirrors_path():
+    return os.path.join(get_dicto_home(), u'mirrors', u'hg')
+
+
 @contextlib.contextmanager
-def hg_open_or_clone_repo(hg_repo):
-    """Open local repo. Clone when non local path is given"""
-    with hg_tmp_clone(hg_repo) as hg_repo_path:
+def hg_mirror(hg_repo, max_age=None):
+    """Updated clone of a remote repository under DICTO_HOME
+
+    Clones the repository the first time and pulls from it on later runs,
+    holding a lock so processes sharing the mirror update it one at a
+    time. Mirrors unused for *max_age* days (default: 30) are removed.
+    """
+    import hglib
+
+    mirrors_path = get_hg_mirrors_path()
+    path = os.path.join(mirrors_path, hashlib.sha1(hg_repo.encode('utf-8')).hexdigest())
+
+    with file_lock(path + u'.lock'):
+        if os.path.isdir(path):
+            try:
+                with contextlib.closing(hglib.open(path)) as client:
+                    client.pull(source=hg_repo.encode('utf-8'))
+            except hglib.error.ServerError as e:
+                click.secho(u'hg: could not pull {}, using mirror as is: {}'
+                            .format(hg_repo, six.text_type(e)), fg='yellow')
+        else:
+            # clone aside, so an interrupted clone never looks like a mirror
+            tmp_path = tempfile.mkdtemp(prefix=u'.dicto-hg', dir=mirrors_path)
+            try:
+                hglib.clone(hg_repo, tmp_path, noupdate=True)
+                os.rename(tmp_path, path)
+            except hglib.error.ServerError as e:
+                error(u'hg: could not clone {} into {}: {}'
+                      .format(hg_repo, path, six.text_type(e)))
+            finally:
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+
+        touch(path)  # last used time, for eviction
+
+    evict_hg_mirrors(max_age if max_age is not None else 30)
+    yield path
+
+
+def evict_hg_mirrors(max_age):
+    """Removes mirrors unused for more than *max_age* days
+
+    Mirrors locked by another process are left alone.
+    """
+    mirrors_path = get_hg_mirrors_path()
+    limit = time.time() - max_age * 24 * 60 * 60
+
+    for name in os.listdir(mirrors_path):
+        path = os.path.join(mirrors_path, name)
+        if not os.path.isdir(path) or os.path.getmtime(path) >= limit:
+            continue
+
+        with file_lock(path + u'.lock', blocking=False) as locked:
+            if locked and os.path.getmtime(path) < limit:
+                shutil.rmtree(path)
+
+
+@contextlib.contextmanager
+def hg_open_or_clone_repo(hg_repo, mirror=True, mirror_max_age=None):
+    """Open local repo. Mirror or clone when non local path is given"""
+    import hglib
+
+    if mirror and is_remote_repo(hg_repo):
+        repo_path = hg_mirror(hg_repo, mirror_max_age)
+    else:
+        repo_path = hg_tmp_clone(hg_repo)
+
+    with repo_path as hg_repo_path:
         try:
             yield hglib.open(hg_repo_path)
         except hglib.error.ServerError as e:
             error(u'hg: {} could not open {}'.format(e, hg_repo))
 
 
+class HgLog(object):
+    """Lazy sequence of the commits in *revset*, at most *limit* of them
+
+    Nothing is read until the commits are used. Iterating pages through
+    the command server *chunk* commits at a time, using the
+    ``limit(set, n, offset)`` revset, instead of holding the whole log.
+    """
+    default_revset = u'reverse(all())'
+
+    def __init__(self, repo, revset=None, limit=None, chunk=500):
+        self.repo = repo
+        self.revset = revset or self.default_revset
+        self.limit = limit
+        self.chunk = chunk
+        self._length = None
+
+    def __iter__(self):
+        offset = 0
+        while self.limit is None or offset < self.limit:
+            size = self.chunk if self.limit is None else min(self.chunk, self.limit - offset)
+            commits = self._read(size, offset)
+            for commit in commits:
+                yield commit
+            if len(commits) < size:
+                break
+            offset += size
+
+    def __len__(self):
+        if self._length is None:
+            output = self.repo.rawcommand([b'log', b'-r', self._revset().encode('utf-8'),
+                                           b'--template', b'.'])
+            self._length = len(output)
+        return self._length
+
+    def __bool__(self):
+        return bool(self._read(1, 0))
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if (index.start or 0) >= 0 and (index.stop or 0) >= 0:
+                return list(itertools.islice(self, index.start, index.stop, index.step))
+            return list(self)[index]
+
+        if index < 0:
+            index += len(self)
+        commits = self._read(1, index) if 0 <= index < self._bound() else []
+        if not commits:
+            raise IndexError(u'hg: commit index out of range')
+        return commits[0]
+
+    def _bound(self):
+        return self.limit if self.limit is not None else float('inf')
+
+    def _revset(self):
+        if self.limit is None:
+            return self.revset
+        return u'limit(({}), {})'.format(self.revset, self.limit)
+
+    def _read(self, size, offset):
+        import hglib
+
+        revset = u'limit(({}), {}, {})'.format(self.revset, size, offset)
+        try:
+            return self.repo.log(revset.encode('utf-8'))
+        except hglib.error.CommandError as e:
+            error(u'hg: could not read commits "{}": {}'
+                  .format(self.revset, assure_unicode(e.err).strip()))
+
+
 def hg_version_objects(repo, tags, hg_repo, hg_version):
     """Gets objects related to tag as a 'version'"""
-    version_tag = first(t for t in tags if t.name == hg_version)
-    if version_tag is None:
+    index = TagIndex((tag.name, tag.node, int(tag.rev))
+                     for tag in tags if tag.name != u'tip')
+    if hg_version not in index:
         error(u'hg: No tag named "{}" in {}'.format(hg_version, hg_repo))
 
-    try:
-        prev_version_tag = tags[tags.index(version_tag) + 1]
-    except IndexError:
+    version_tag = first(t for t in tags if t.name == hg_version)
+    prev_version_name = index.previous(hg_version)
+    if prev_version_name is None:
         revspec = version_tag.name
     else:
-        revspec = version_tag.name + u':' + prev_version_tag.name
+        revspec = version_tag.name + u':' + prev_version_name
 
     version_commits = repo.log(revspec)
     if not version_commits:
@@ -530,26 +2343,39 @@ def hg_version_objects(repo, tags, hg_repo, hg_version):
     return version_tag, version_commits
 
 
-def fetch_hg_data(hg_repo, hg_version):
+def fetch_hg_data(hg_repo, hg_version, hg_mirror=None, hg_mirror_max_age=None,
+                  hg_revset=None, hg_log_limit=None, needs=None):
     """Return a dict with mercurial repo data resources
 
       hg_repo: Object for *hg_repo* mercurial repository
       hg_tags: List of all tag objects in *hg_repo*
-      hg_commits: List of all commit objects in *hg_repo*
+      hg_commits: Lazy sequence of the commit objects in *hg_revset*
+       (default: all), up to *hg_log_limit* of them, see :class:`HgLog`
       hg_version_tag: Tag object named *hg_version*
       hg_version_commits: List of all commit objects in *hg_repo*
        between *hg_version* tag and the previous one (if any).
+
+    Remote repositories are mirrored under DICTO_HOME unless *hg_mirror*
+    is False, see :func:`hg_mirror`.
     """
     if not hg_repo:
         error(u'hg: No repository given')
 
-    with hg_open_or_clone_repo(hg_repo) as repo:
+    mirror = hg_mirror is not False
+    with hg_open_or_clone_repo(hg_repo, mirror, hg_mirror_max_age) as repo:
         version_tag = None
         version_commits = []
-        commits = repo.log()
-        tags = [make_hg_tag(*tag) for tag in repo.tags()]
+        commits = tags = None
+
+        if wanted(needs, u'hg_commits'):
+            commits = HgLog(repo, hg_revset, hg_log_limit)
+            if is_remote_repo(hg_repo) and not mirror:
+                commits = list(commits)  # temporary clone is removed on exit
+
+        if wanted(needs, u'hg_tags', u'hg_version_tag', u'hg_version_commits'):
+            tags = [make_hg_tag(*tag) for tag in repo.tags()]
 
-        if hg_version:
+        if hg_version and wanted(needs, u'hg_version_tag', u'hg_version_commits'):
             version_tag, version_commits = \
                 hg_version_objects(repo, tags, hg_repo, hg_version)
 
@@ -563,39 +2389,91 @@ def fetch_hg_data(hg_repo, hg_version):
     )
 
 
-def chef_start_api():
-    """Horribly patches chef api to skip SSL cert validation"""
-    from chef.api import ChefRequest
+def chef_start_api(insecure=False, jobs=None):
+    """Chef api from knife/client config using a pooled transport
 
+    Certificates are not verified when *insecure* or when the config says
+    ``ssl_verify_mode :verify_none``. See :func:`make_chef_transport`.
+    """
+    chef = import_chef()
     api = chef.autoconfigure()
+    if api is None:
+        error(u'chef: No knife.rb or client.rb configuration found')
+
+    # PyChef 0.3 uses requests and checks the response by itself
+    returns_response = not hasattr(chef.api, u'ChefRequest')
+    insecure = insecure or not getattr(api, u'ssl_verify', True)  # knife.rb
+    api._request = make_chef_transport(insecure, jobs, returns_response)
+    return api
+
+
+def make_chef_transport(insecure=False, jobs=None, returns_response=False):
+    """Patch for the chef api ``_request`` method over keep-alive connections
+
+    Up to *jobs* (default: 8) connections are kept open and shared, with
+    a single SSL context, instead of a new connection by request. Server
+    certificates are not verified when *insecure*. Failed requests raise
+    :class:`HTTPError` as PyChef expects, unless *returns_response*.
+    """
+    from six.moves.urllib.error import HTTPError
+
+    session = make_http_session(jobs or 8)
+    if insecure:  # asked for, so do not warn on every request
+        import requests
+        requests.packages.urllib3.disable_warnings(
+            requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
     def _request(method, url, data, headers):
-        request = ChefRequest(url, data, headers, method=method)
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        return urlopen(request, context=ctx).read()
+        response = session.request(method, url, data=data, headers=headers,
+                                   verify=not insecure)
+        if returns_response:
+            return response
+        if response.status_code >= 400:
+            raise HTTPError(url, response.status_code, response.reason,
+                            response.headers, io.BytesIO(response.content))
+        return response.content
 
-    api._request = _request
+    return _request
 
-    return api
+
+def import_chef():
+    try:
+        import chef
+    except Exception as e:  # may not even be importable on this python
+        error(u'chef: Not available in this platform: {}'.format(e))
+    return chef
 
 
-def get_chef_data():
-    return fetch_chef_data()
+def prepare_chef_args(chef_config):
+    return chef_config
 
 
-def fetch_chef_data():
+def fetch_chef_data(chef_insecure=None, chef_jobs=None, chef_query=None,
+                    chef_attributes=None, needs=None):
     """Return a dict with chef repo data resources
 
       chef_envs: dict of environments by name. Object has `name`, `attributes`
       and `cookbook_versions`.
       chef_nodes: dict of nodes by name. Object has `name`, `attributes`,
        `chef_environment`, `cookbooks`, `run_list`.
+
+    Server certificates are verified unless *chef_insecure*, and up to
+    *chef_jobs* connections are kept open, see :func:`make_chef_transport`.
+
+    Given *chef_query* or *chef_attributes*, chef_nodes are instead dicts
+    of just those attributes for the nodes found, see :func:`search_chef_nodes`.
     """
-    api = chef_start_api()
-    chef_envs = chef.Environment.list()
-    chef_nodes = chef.Node.list()
+    chef = import_chef()
+    api = chef_start_api(chef_insecure, chef_jobs)
+    chef_envs = chef_nodes = None
+
+    if wanted(needs, u'chef_envs'):
+        chef_envs = chef.Environment.list(api=api)
+
+    if wanted(needs, u'chef_nodes') and (chef_query or chef_attributes):
+        chef_nodes = search_chef_nodes(api, chef_query, chef_attributes, chef_jobs)
+    elif wanted(needs, u'chef_nodes'):
+        chef_nodes = chef.Node.list(api=api)
 
     return dict(
         chef_api=api,
@@ -604,10 +2482,50 @@ def fetch_chef_data():
     )
 
 
-def get_apt_data(kwargs):
+def search_chef_nodes(api, query=None, attributes=None, jobs=None):
+    """Dict by name of the *attributes* of the nodes matching *query*
+
+    Uses chef partial search, so the server sends just the *attributes*,
+    given as ``name:dotted.path`` strings, instead of whole nodes. The
+    first page of results gives the total and the rest of pages are
+    asked up to *jobs* (default: 8) at the same time.
+    """
+    from six.moves.urllib.parse import urlencode
+
+    keys = parse_chef_attributes(attributes or chef_default_attributes)
+    keys.setdefault(u'name', [u'name'])
+
+    def search(start):
+        path = u'/search/node?' + urlencode(dict(
+            q=query or u'*:*', start=start, rows=chef_search_rows))
+        return api.api_request(u'POST', path, data=keys)
+
+    page = search(0)
+    starts = range(chef_search_rows, page.get(u'total', 0), chef_search_rows)
+    pages = [page] + parallel_map(search, starts, jobs or 8)
+
+    nodes = [row[u'data'] for page in pages for row in page[u'rows']]
+    return collections.OrderedDict(
+        (node[u'name'], node) for node in sorted(nodes, key=lambda node: node[u'name']))
+
+
+chef_default_attributes = (u'name', u'chef_environment', u'run_list')
+chef_search_rows = 1000
+
+
+def parse_chef_attributes(attributes):
+    """Partial search keys dict from ``name:dotted.path`` strings"""
+    keys = {}
+    for attribute in attributes:
+        name, _, path = attribute.partition(u':')
+        keys[name] = (path or name).split(u'.')
+    return keys
+
+
+def prepare_apt_args(kwargs):
     required = get_function_args(fetch_apt_data)
     prompt_for_missing_values(kwargs, required)
-    return fetch_apt_data(**kwargs)
+    return kwargs
 
 
 apt_regex = re.compile(r'''
@@ -619,64 +2537,144 @@ apt_regex = re.compile(r'''
 ''', re.VERBOSE)
 
 
-def fetch_apt_package(apt_url, name):
+def fetch_apt_package(apt_url, name, session=None, cache=None):
+    import natsort
+
     url = urljoin(apt_url, u'pool', u'main', name[0], name)
+    listing = http_get(session or make_http_session(), url, cache)
     package = dict(name=name, url=url)
     package['versions'] = natsort.natsorted(
         (dict(name=name, date=date, size=size, url=urljoin(url, name))
-         for name, date, size in apt_regex.findall(requests.get(url).content)),
+         for name, date, size in apt_regex.findall(listing.decode('utf-8', 'replace'))),
         key=lambda v: v['name'])
     return package
 
 
-def fetch_apt_data(apt_url, apt_packages):
+def fetch_apt_data(apt_url, apt_packages, apt_jobs=None, apt_backend=None,
+                   apt_index=None, needs=None):
     """Return a dict with apt repo resources
 
       apt_packages: dict of `dict` with apt packages by name for given
        packages.  dict has `name`, `url` and `versions`. The `versions` entry
        is a list of dict with `name`, `url`, `date`, `size`
 
-    Package names are naturally sorted.
-    """
-    apt_packages = {name: fetch_apt_package(apt_url, name) for name in apt_packages}
-    return dict(apt_packages=apt_packages)
-
+    Package names are naturally sorted. Up to *apt_jobs* packages are
+    fetched at the same time over the same keep-alive connections.
 
-def get_git_data(git_config):
+    The ``index`` *apt_backend* downloads the *apt_index* Packages files
+    once instead of a pool directory listing by package. Indexes have no
+    file dates, so ``date`` is None.
+    """
+    jobs = apt_jobs or 8
+    cache = get_http_cache()
+    with contextlib.closing(make_http_session(jobs)) as session:
+        try:
+            if apt_backend == u'index':
+                index = fetch_apt_index(apt_url, apt_index or apt_default_index,
+                                        session, cache)
+                packages = [apt_index_package(index, apt_url, name)
+                            for name in apt_packages]
+            else:
+                packages = parallel_map(
+                    lambda name: fetch_apt_package(apt_url, name, session, cache),
+                    apt_packages, jobs)
+        finally:
+            cache.save_stats()
+
+    return dict(apt_packages={package['name']: package for package in packages})
+
+
+apt_default_index = (u'dists/stable/main/binary-amd64/Packages.gz',)
+
+
+def fetch_apt_index(apt_url, paths, session, cache=None):
+    """Index of (file name, size) tuples by package name from Packages files"""
+    index = collections.defaultdict(list)
+    for path in paths:
+        content = http_get(session, urljoin(apt_url, path), cache)
+        stream = io.BytesIO(content)
+        if path.endswith(u'.gz'):
+            stream = gzip.GzipFile(fileobj=stream)
+
+        for package in parse_apt_index(stream):
+            index[package[u'Package']].append(
+                (package[u'Filename'], package.get(u'Size')))
+    return index
+
+
+def parse_apt_index(stream):
+    """Yields a dict of the fields of each package stanza in a Packages file"""
+    fields = {}
+    for line in stream:
+        line = line.decode('utf-8', 'replace').rstrip()
+        if not line:
+            if u'Package' in fields and u'Filename' in fields:
+                yield fields
+            fields = {}
+        elif not line[0].isspace():  # skip multiline field continuations
+            name, _, value = line.partition(u':')
+            if name in (u'Package', u'Version', u'Filename', u'Size'):
+                fields[name] = value.strip()
+
+    if u'Package' in fields and u'Filename' in fields:
+        yield fields
+
+
+def apt_index_package(index, apt_url, name):
+    """Package dict for *name* as fetch_apt_package returns"""
+    import natsort
+
+    files = index.get(name, ())
+    url = urljoin(apt_url, files[0][0].rsplit(u'/', 1)[0] if files else
+                  urljoin(u'pool', u'main', name[0], name))
+    versions = (dict(name=filename.rsplit(u'/', 1)[-1], date=None, size=size,
+                     url=urljoin(apt_url, filename))
+                for filename, size in files)
+    return dict(name=name, url=url, versions=natsort.natsorted(
+        versions, key=lambda v: v['name']))
+
+
+def prepare_git_args(git_config):
     required = get_function_args(fetch_git_data)
     prompt_for_missing_values(git_config, required)
-    return fetch_git_data(**git_config)
+    return git_config
 
 
-def git_version_objects(repo, tags, git_repo, git_version):
-    """Get a tag and its related commits"""
-    version_tag = first(tag for tag in tags if tag.name == git_version)
-    if version_tag is None:
+def git_version_objects(repo, tags, git_repo, git_version, log=None):
+    """Get a tag and its related commits
+
+    The previous version is the previous tag in history order, see
+    :func:`git_tag_index`. Commits are read with *log*, defaulting to
+    ``repo.iter_commits``.
+    """
+    import git
+
+    index = git_tag_index(repo.git_dir)
+    if git_version in index:
+        version_tag = git.TagReference(repo, u'refs/tags/' + git_version)
+        prev_version_name = index.previous(git_version)
+    else:
         version_tag = first(ref for ref in repo.refs if ref.name == u'master')
         click.secho(u'git: No tag named "{}" in "{}" Will use {}'
             .format(git_version, git_repo, version_tag.name), fg='yellow')
 
-    try:
-        prev_version_tag = tags[tags.index(version_tag) - 1]
-    except (IndexError, ValueError):
-        if repo.tags:
-            # if version_tag is a ref and not a tag, previous tag cannot be
-            # calculated and more recent tag is selected as previous version
-            revspec = repo.tags[-1].name + u'..' + version_tag.name
-        else:
-            # up to the end of the repo
-            revspec = version_tag.name
+        # if version_tag is a ref and not a tag, previous tag cannot be
+        # calculated and the latest tag before it is the previous version
+        prev_version_name = index.latest_before(version_tag.commit.committed_date)
 
+    if prev_version_name is None:
+        # up to the end of the repo
+        revspec = version_tag.name
     else:
         # from given tag to the previous one
-        revspec = prev_version_tag.name + u'..' + version_tag.name
+        revspec = prev_version_name + u'..' + version_tag.name
 
     # TODO: make it appear only on verbose
     click.secho(u'git: Will get version commits for revs {}'.format(revspec))
 
     # Get commits within revision but the last one, because
     # it will belong to the previous version.
-    version_commits = list(repo.iter_commits(revspec))
+    version_commits = list((log or repo.iter_commits)(revspec))
     if not version_commits:
         click.secho(u'git: No commits for version {} in {}'
                    .format(revspec, git_repo), fg='yellow')
@@ -684,28 +2682,53 @@ def git_version_objects(repo, tags, git_repo, git_version):
     return version_tag, version_commits
 
 
-def fetch_git_data(git_repo, git_version):
+def fetch_git_data(git_repo, git_version, git_backend=None, git_stats=None,
+                   needs=None):
     """Return a dict with git repo data resources
 
       git_repo: Object for *git_repo* mercurial repository
       git_tags: List of all tag objects in *git_repo*
-      git_commits: List of all commit objects in *git_repo*
+      git_commits: Lazy sequence of all commit objects in *git_repo*,
+       see :class:`GitLog`
       git_version_tag: Tag object named *git_version*
       git_version_commits: List of all commit objects in *git_repo*
        between *git_version* tag and the previous one (if any).
+      git_version_stats: Totals of files and lines changed by the version
+       commits when *git_stats* is enabled. See :func:`git_stats_totals`.
+
+    The ``log`` *git_backend* reads commits as :class:`GitCommit` records
+    from a single ``git log`` run instead of GitPython objects.
     """
     if not git_repo:
         error(u'git: No repository given')
 
+    import git
+
     repo = git.Repo(git_repo)
     tags = repo.tags
-    commits = repo.iter_commits()
+    commits = None
+
+    log = None
+    if git_backend == u'log':
+        log = functools.partial(iter_git_log, repo.git_dir)
 
-    if not git_version:
+    if wanted(needs, u'git_commits'):
+        commits = GitLog(log or repo.iter_commits)
+
+    version_stats = None
+    if not git_version or not wanted(
+            needs, u'git_version_tag', u'git_version_commits', u'git_version_stats'):
         version_tag, version_commits = None, None
     else:
         version_tag, version_commits = \
-            git_version_objects(repo, tags, git_repo, git_version)
+            git_version_objects(repo, tags, git_repo, git_version, log)
+
+        if git_stats:
+            stats = read_git_stats(repo.git_dir, [c.hexsha for c in version_commits])
+            for commit in version_commits:
+                if isinstance(commit, GitCommit):
+                    commit.stats = stats.get(commit.hexsha)
+            version_stats = git_stats_totals(stats)
 
     return dict(
         git_repo=repo,
@@ -713,10 +2736,322 @@ def fetch_git_data(git_repo, git_version):
         git_commits=commits,
         git_repo_path=git_repo,
         git_version_tag=version_tag,
-        git_version_commits=version_commits
+        git_version_commits=version_commits,
+        git_version_stats=version_stats
     )
 
 
+def git_tag_index(git_dir):
+    """Index of repository tags in history order
+
+    Tags are ordered by their tagger date, or commit date for lightweight
+    tags. Cached between runs until any tag ref file, nested ones too,
+    is added, removed or changed.
+    """
+    refs = [os.path.join(git_dir, u'packed-refs')]
+    for root, _, names in os.walk(os.path.join(git_dir, u'refs', u'tags')):
+        refs.extend(os.path.join(root, name) for name in names)
+    cache = get_tags_cache()
+    key = cache.make_key(os.path.abspath(git_dir),
+                         [(path, os.path.getmtime(path)) for path in sorted(refs)
+                          if os.path.exists(path)])
+
+    tags = cache.get(key)
+    if tags is None:
+        tags = read_git_tags(git_dir)
+        cache.set(key, tags)
+
+    return TagIndex(tags)
+
+
+def read_git_tags(git_dir):
+    """List of (name, commit sha, date) for all tags in a single git run"""
+    output = subprocess.check_output([
+        u'git', u'--git-dir', git_dir, u'for-each-ref',
+        u'--format=%(refname)%00%(objectname)%00%(*objectname)%00%(creatordate:unix)',
+        u'refs/tags'])
+
+    tags = []
+    for line in assure_unicode(output).splitlines():
+        refname, objectname, commit, date = line.split(u'\x00')
+        tags.append((refname[len(u'refs/tags/'):], commit or objectname,
+                     int(date or 0)))
+    return tags
+
+
+class TagIndex(object):
+    """Tags ordered from oldest to newest
+
+    Built from (name, commit, order) tuples, being order a date or a
+    revision number. Looks up tags by name in O(1) and the latest tag
+    up to a given order in O(log n).
+    """
+    def __init__(self, tags):
+        self.tags = sorted(tags, key=lambda tag: (tag[2], tag[0]))
+        self.positions = {tag[0]: position for position, tag in enumerate(self.tags)}
+        self.orders = [tag[2] for tag in self.tags]
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def __len__(self):
+        return len(self.tags)
+
+    def previous(self, name):
+        """Name of the tag before *name* or None if it is the first one"""
+        position = self.positions[name]
+        return self.tags[position - 1][0] if position else None
+
+    def latest_before(self, order):
+        """Name of the latest tag with order up to *order* or None"""
+        position = bisect.bisect_right(self.orders, order)
+        return self.tags[position - 1][0] if position else None
+
+
+class GitLog(object):
+    """Lazy sequence of the commits iterated by calling *log*
+
+    Nothing is read until the commits are used, and they are read again
+    each time, so the same context can be rendered more than once.
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def __iter__(self):
+        return iter(self.log())
+
+
+git_log_format = u'%x1e' + u'%x00'.join(
+    [u'%H', u'%an', u'%ae', u'%at', u'%cn', u'%ce', u'%ct', u'%D', u'%B'])
+
+
+def iter_git_log(git_dir, revspec=None):
+    """Yields a :class:`GitCommit` for each commit in a single git log run
+
+    Reads the log output as a stream, so commits are available as soon as
+    git outputs them and the full log is never held in memory.
+    """
+    name_revs = GitNameRevs(git_dir, revspec)
+    command = [u'git', u'--git-dir', git_dir, u'log', u'--format=' + git_log_format]
+    if revspec:
+        command.append(revspec)
+
+    for record in iter_git_records(command):
+        yield make_git_commit(record, name_revs)
+
+
+def iter_git_records(command, input=None):
+    """Yields the records of a git command output separated by \\x1e
+
+    The output is read as a stream. *input* lines are written to the
+    command stdin from a thread while reading.
+    """
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE if input is not None else None)
+
+    if input is not None:
+        def write():
+            try:
+                for line in input:
+                    process.stdin.write(line.encode('utf-8') + b'\n')
+            finally:
+                process.stdin.close()
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+
+    try:
+        buffer = b''
+        for chunk in iter(functools.partial(process.stdout.read, 64 * 1024), b''):
+            records = (buffer + chunk).split(b'\x1e')
+            buffer = records.pop()
+            for record in records:
+                if record:
+                    yield record
+        if buffer:
+            yield buffer
+    except GeneratorExit:  # not fully read
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode:
+        error(u'git: Could not run {}'.format(u' '.join(command)))
+
+
+def read_git_stats(git_dir, hexshas):
+    """Files and lines changed by each commit from a single git log run
+
+    Returns a dict by commit sha with the shape of GitPython ``Commit.stats``:
+    ``total`` dict with ``insertions``, ``deletions``, ``lines`` and
+    ``files`` and ``files`` dict by path with the same counts.
+    """
+    if not hexshas:  # git log would read HEAD
+        return {}
+
+    command = [u'git', u'--git-dir', git_dir, u'log', u'--stdin',
+               u'--no-walk=unsorted', u'--numstat', u'--format=%x1e%H']
+
+    stats = {}
+    for record in iter_git_records(command, hexshas):
+        lines = record.decode('utf-8', 'replace').splitlines()
+        files = {}
+        for line in lines[1:]:
+            if line:
+                insertions, deletions, path = line.split(u'\t', 2)
+                insertions = int(insertions) if insertions != u'-' else 0  # binary
+                deletions = int(deletions) if deletions != u'-' else 0
+                files[path] = dict(insertions=insertions, deletions=deletions,
+                                   lines=insertions + deletions)
+
+        total = dict(files=len(files), insertions=0, deletions=0, lines=0)
+        for counts in files.values():
+            for name in (u'insertions', u'deletions', u'lines'):
+                total[name] += counts[name]
+        stats[lines[0]] = dict(total=total, files=files)
+
+    return stats
+
+
+def git_stats_totals(stats, top=10):
+    """Adds up commits stats
+
+    Returns a dict with the number of ``commits``, changed ``files``,
+    ``insertions``, ``deletions`` and ``lines``, the ``top`` most
+    changed paths as ``top_paths`` (path, lines) list and the stats of
+    each commit by sha as ``by_commit``.
+    """
+    paths = collections.Counter()
+    totals = dict(insertions=0, deletions=0, lines=0)
+    for commit_stats in stats.values():
+        for path, counts in commit_stats[u'files'].items():
+            paths[path] += counts[u'lines']
+        for name in totals:
+            totals[name] += commit_stats[u'total'][name]
+
+    return dict(totals, commits=len(stats), files=len(paths),
+                top_paths=paths.most_common(top), by_commit=stats)
+
+
+def make_git_commit(record, name_revs=None):
+    (hexsha, author, author_email, authored_date, committer, committer_email,
+     committed_date, refs, message) = record.decode('utf-8', 'replace').split(u'\x00', 8)
+
+    # git log ends each message with an extra newline
+    if message.endswith(u'\n'):
+        message = message[:-1]
+
+    return GitCommit(
+        hexsha=hexsha,
+        author=GitActor(author, author_email),
+        authored_date=int(authored_date),
+        committer=GitActor(committer, committer_email),
+        committed_date=int(committed_date),
+        refs=[ref for ref in refs.split(u', ') if ref],
+        message=message,
+        name_revs=name_revs)
+
+
+@six.python_2_unicode_compatible
+class GitActor(collections.namedtuple(u'Actor', [u'name', u'email'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+@six.python_2_unicode_compatible
+class GitCommit(object):
+    """Commit data read from git log
+
+    Has the attributes of a GitPython Commit most used in templates.
+    ``refs`` are the refs decorating the commit, as in ``git log --decorate``.
+    ``stats`` are only set when requested, see :func:`read_git_stats`.
+    """
+    __slots__ = (u'hexsha', u'author', u'authored_date', u'committer',
+                 u'committed_date', u'refs', u'message', u'name_revs', u'stats')
+
+    def __init__(self, hexsha, author, authored_date, committer,
+                 committed_date, refs, message, name_revs=None):
+        self.hexsha = hexsha
+        self.author = author
+        self.authored_date = authored_date
+        self.committer = committer
+        self.committed_date = committed_date
+        self.refs = refs
+        self.message = message
+        self.name_revs = name_revs
+        self.stats = None
+
+    @property
+    def summary(self):
+        return self.message.split(u'\n', 1)[0]
+
+    @property
+    def authored_datetime(self):
+        return datetime.datetime.fromtimestamp(self.authored_date)
+
+    @property
+    def committed_datetime(self):
+        return datetime.datetime.fromtimestamp(self.committed_date)
+
+    @property
+    def name_rev(self):
+        """Commit sha and its name relative to refs, as ``git name-rev``"""
+        if self.name_revs is None:
+            return self.hexsha
+        return self.name_revs.get(self.hexsha)
+
+    def __str__(self):
+        return self.hexsha
+
+    def __repr__(self):
+        return u'<GitCommit "{}">'.format(self.hexsha)
+
+
+class GitNameRevs(object):
+    """Names the commits in a revspec relative to refs, as ``git name-rev``
+
+    All of them are named together the first time any of them is asked
+    for, feeding ``git rev-list`` output to a single ``git name-rev`` run.
+    """
+    def __init__(self, git_dir, revspec=None):
+        self.git_dir = git_dir
+        self.revspec = revspec
+        self.names = None
+        self.lock = threading.Lock()
+
+    def get(self, hexsha):
+        with self.lock:
+            if self.names is None:
+                self.names = self.resolve()
+        return hexsha + u' ' + self.names.get(hexsha, u'undefined')
+
+    def resolve(self):
+        git = [u'git', u'--git-dir', self.git_dir]
+        hexshas = subprocess.check_output(
+            git + [u'rev-list', self.revspec or u'HEAD'])
+
+        for option in (u'--annotate-stdin', u'--stdin'):  # git < 2.35
+            process = subprocess.Popen(
+                git + [u'name-rev', option], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, _ = process.communicate(hexshas)
+            if not process.returncode:
+                break
+
+        names = {}
+        for line in assure_unicode(output).splitlines():
+            hexsha, _, name = line.partition(u' ')
+            if name:
+                names[hexsha] = name.strip(u'()')
+        return names
+
+
 def make_shell(obj, context):
     banner = """\
   __/   .  __  -/- _,_
@@ -758,28 +3093,291 @@ def echo(obj, message, level='normal', intend='info'):
 
 
 def get_function_args(callable):
-    return inspect.getargspec(callable).args
+    """Names of the arguments without a default value"""
+    try:
+        spec = inspect.getfullargspec(callable)
+    except AttributeError:  # python 2
+        spec = inspect.getargspec(callable)
+    return spec.args[:len(spec.args) - len(spec.defaults or ())]
 
 
 def assure_unicode(text):
     return text.decode('utf-8') if isinstance(text, bytes) else text
 
 
-def command_output(cmd):
+def command_output(cmd, timeout=None):
     """Run external command and get the result
 
-    Supposes utf-8 encoding for the command output
+    Supposes utf-8 encoding for the command output. Commands running for
+    more than *timeout* seconds are killed, along with their children.
     """
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               **new_process_group)
+    killed = []
+
+    def kill():
+        killed.append(True)
+        kill_process_group(process)
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
     try:
-        return assure_unicode(subprocess.check_output(cmd, shell=True))
-    except subprocess.CalledProcessError as error:
+        output, _ = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+
+    if killed:
+        click.secho(u'Failed to execute "{}". The program was killed after {}s'
+                    .format(cmd, timeout))
+    elif process.returncode:
         click.secho(u'Failed to execute "{}". The program exited unexpectedly'
                     u' with code {} and output: {}'
-                    .format(cmd, error.returncode, error.output))
+                    .format(cmd, process.returncode, output))
+    else:
+        return assure_unicode(output)
+
+
+# children get their own process group, to kill them all on timeout
+new_process_group = (dict(start_new_session=True) if six.PY3 else
+                     dict(preexec_fn=getattr(os, u'setsid', None)))
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, 9)
+    except (AttributeError, OSError):  # no process groups or already gone
+        process.kill()
+
+
+def _get_exe_output(exes, timeout=None, jobs=None, cache=None, refresh=False):
+    """Outputs of the *exes* commands by name, all run at the same time
+
+    Commands are strings, or dicts with a ``command`` and optionally a
+    ``timeout`` in seconds (default: *timeout*, 0 for none), the
+    ``inputs`` files the output depends on and ``cache``. Outputs of
+    ``cache`` commands are reused while the command, working directory
+    and inputs modification times are the same. A number of seconds as
+    ``cache`` also expires them.
+    """
+    commands = [make_exe_command(name, exe, timeout) for name, exe in exes.items()]
+
+    def run(command):
+        if not command.cache or cache is None:
+            return command_output(command.command, command.timeout)
+
+        key = cache.make_key(command.command, os.getcwd(), [
+            (path, os.path.getmtime(path) if os.path.exists(path) else None)
+            for path in map(os.path.abspath, command.inputs)])
+        ttl = command.cache if command.cache is not True else None
+        output = None if refresh else cache.get(key, ttl)
+        cache.count(command.name, u'hits' if output is not None else u'misses')
+        if output is None:
+            output = command_output(command.command, command.timeout)
+            if output is not None:
+                cache.set(key, output)
+        return output
+
+    try:
+        outputs = parallel_map(run, commands, jobs)
+    finally:
+        if cache is not None:
+            cache.save_stats()
+    return {command.name: output for command, output in zip(commands, outputs)}
 
 
-def _get_exe_output(exes):
-    return {name: command_output(cmd) for name, cmd in exes.items()}
+exe_command = collections.namedtuple(
+    u'ExeCommand', [u'name', u'command', u'timeout', u'inputs', u'cache'])
+
+
+def make_exe_command(name, exe, timeout=None):
+    if not isinstance(exe, dict):
+        exe = dict(command=exe)
+    if not exe.get(u'command'):
+        error(u'exe: No command given for {}'.format(name))
+
+    return exe_command(
+        name, exe[u'command'],
+        exe.get(u'timeout', timeout),
+        exe.get(u'inputs') or [], exe.get(u'cache') or False)
+
+
+def parallel_map(function, items, jobs=None):
+    """Maps function over items in a pool of threads keeping items order
+
+    Uses as many threads as items unless *jobs* is given and
+    runs serially when there is only one job to run.
+    """
+    items = list(items)
+    jobs = min(jobs or len(items), len(items))
+    if jobs <= 1:
+        return [function(item) for item in items]
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def make_http_session(pool_size=10):
+    """HTTP session keeping up to *pool_size* connections alive by host
+
+    Requests block while all connections are busy, bounding concurrency.
+    """
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount(u'http://', adapter)
+    session.mount(u'https://', adapter)
+    return session
+
+
+def http_get(session, url, cache=None):
+    """Gets url contents revalidating any cached copy with the server
+
+    Cached responses are requested with their ETag and Last-Modified
+    validators, so unchanged contents come back as 304 Not Modified.
+    Any other response than these two is an error.
+    """
+    key = cache.make_key(url) if cache else None
+    cached = cache.get(key) if cache else None
+
+    headers = {}
+    if cached and cached[u'etag']:
+        headers[u'If-None-Match'] = cached[u'etag']
+    if cached and cached[u'last_modified']:
+        headers[u'If-Modified-Since'] = cached[u'last_modified']
+
+    response = session.get(url, headers=headers)
+    if cached and response.status_code == 304:
+        cache.count(u'http', u'hits')
+        return cached[u'content']
+
+    if response.status_code != 200:
+        error(u'apt: Could not get {}: HTTP {}'.format(url, response.status_code))
+
+    if cache:
+        cache.count(u'http', u'misses')
+    validators = dict(etag=response.headers.get(u'ETag'),
+                      last_modified=response.headers.get(u'Last-Modified'))
+    if cache and any(validators.values()):
+        cache.set(key, dict(validators, content=response.content))
+
+    return response.content
+
+
+def make_dirs(directory):
+    """Creates *directory* and its parents unless they exist
+
+    Concurrent renders may be creating the same directory at once.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def atomic_write(path, data):
+    """Writes bytes to path through a temporary file and a rename"""
+    with atomic_file(path) as stream:
+        stream.write(data)
+
+
+@contextlib.contextmanager
+def atomic_file(path, sync=False):
+    """Binary file replacing *path* by a rename once closed without errors
+
+    The file is created in the same directory, keeping the mode of any
+    previous file. When *sync*, its contents are flushed to disk before
+    the rename, so after a crash *path* has either the old or the new
+    contents.
+    """
+    directory = os.path.dirname(path)
+    make_dirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=u'.dicto-')
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            yield stream
+            if sync:
+                stream.flush()
+                os.fsync(stream.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except BaseException:
+        remove_file(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """Exclusive lock between processes on a lock file at *path*
+
+    Yields whether the lock was taken, which is always the case when
+    *blocking*. Platforms without ``fcntl`` are not locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    make_dirs(os.path.dirname(path))
+
+    with open(path, 'a') as stream:
+        locked = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except (IOError, OSError):
+                locked = False
+
+        try:
+            yield locked
+        finally:
+            if fcntl is not None and locked:
+                fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+plain_types = six.string_types + six.integer_types + (
+    six.binary_type, float, bool, type(None), datetime.date)
+
+
+def is_plain_data(value):
+    """Whether value is made of builtin types that are safe to store
+
+    Besides lists and tuples, only namedtuples of this module are plain,
+    as others may not be loaded back, like hglib revisions.
+    """
+    if isinstance(value, (list, tuple)):
+        if type(value) not in (list, tuple) and type(value).__module__ != __name__:
+            return False
+        return all(is_plain_data(item) for item in value)
+    if isinstance(value, dict):
+        return all(is_plain_data(k) and is_plain_data(v) for k, v in value.items())
+    return isinstance(value, plain_types)
 
 
 def first(collection):
@@ -0,0 +1,330 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import logging
+import collections
+import tempfile
+import subprocess
+from unittest import SkipTest
+
+from hamcrest import assert_that, empty, less_than
+
+import dicto
+from tests.test_cli import make_server_ssl_context, serve_pages, stop_server
+
+
+logger = logging.getLogger(u'tests.benchmarks')
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), u'..'))
+
+# Budget for the cold startup of `dicto --version`, in milliseconds
+STARTUP_BUDGET = int(os.getenv(u'DICTO_STARTUP_BUDGET', 300))
+HEAVY_MODULES = (u'git', u'hglib', u'redmine', u'chef', u'requests',
+                 u'natsort', u'yaml')
+# Size of the synthetic repositories
+COMMITS = int(os.getenv(u'DICTO_BENCHMARK_COMMITS', 200))
+HG_COMMITS = int(os.getenv(u'DICTO_BENCHMARK_HG_COMMITS', 5000))
+# Requests to the stand-in chef server
+CHEF_REQUESTS = int(os.getenv(u'DICTO_BENCHMARK_CHEF_REQUESTS', 100))
+# Macros in the synthetic template
+TEMPLATE_MACROS = int(os.getenv(u'DICTO_BENCHMARK_TEMPLATE_MACROS', 300))
+# Commits in the rendered changelog
+RENDER_COMMITS = int(os.getenv(u'DICTO_BENCHMARK_RENDER_COMMITS', 50000))
+# Size of the file to prepend to and memory allowed for it, in MiB
+PREPEND_SIZE = int(os.getenv(u'DICTO_BENCHMARK_PREPEND_SIZE', 50))
+PREPEND_BUDGET = int(os.getenv(u'DICTO_BENCHMARK_PREPEND_BUDGET', 1))
+
+
+class TestStartupTime(object):
+    def test_it_does_not_import_resource_backends(self):
+        modules = imported_modules(u'import dicto')
+
+        assert_that([name for name in HEAVY_MODULES if name in modules], empty())
+
+    def test_version_startup_is_within_budget(self):
+        times = import_times(u'import dicto; '
+                             u'dicto.cli([u"--version"])')
+
+        total = sum(cumulative for _, cumulative in times.values()) / 1000.0
+        logger.info(u'dicto --version imports took {:.1f}ms'.format(total))
+        assert_that(total, less_than(STARTUP_BUDGET))
+
+
+class TestGitLogBackend(object):
+    def setup(self):
+        self.repo = make_synthetic_git_repo(COMMITS)
+
+    def test_it_reads_commits_faster_than_gitpython(self):
+        import git
+
+        repo = git.Repo(self.repo)
+        gitpython = timed(lambda: render_commits(repo.iter_commits()))
+        log = timed(lambda: render_commits(dicto.iter_git_log(repo.git_dir)))
+
+        logger.info(u'{} commits: gitpython {:.3f}s, git log {:.3f}s'
+                    .format(COMMITS, gitpython, log))
+        assert_that(log, less_than(gitpython))
+
+
+class TestHgLog(object):
+    def setup(self):
+        if sys.version_info < (3, 4):
+            raise SkipTest(u'tracemalloc needs python 3.4')
+        try:
+            import hglib
+            self.repo = hglib.open(make_synthetic_hg_repo(HG_COMMITS))
+        except (ImportError, OSError):
+            raise SkipTest(u'mercurial is not installed')
+
+    def teardown(self):
+        if hasattr(self, u'repo'):
+            self.repo.close()
+
+    def test_it_pages_commits_in_less_memory_than_full_log(self):
+        full = peak_memory(lambda: len(self.repo.log()))
+        paged = peak_memory(lambda: sum(1 for _ in dicto.HgLog(self.repo)))
+
+        logger.info(u'{} hg commits peak memory: full log {}KiB, paged {}KiB'
+                    .format(HG_COMMITS, full // 1024, paged // 1024))
+        assert_that(paged, less_than(full))
+
+
+class TestChefTransport(object):
+    def setup(self):
+        self.server = serve_pages(
+            {u'/nodes/web{}'.format(number): u'{{"name": "web{}"}}'.format(number)
+             for number in range(CHEF_REQUESTS)},
+            ssl_context=make_server_ssl_context())
+        self.urls = [self.server.url + u'/nodes/web{}'.format(number)
+                     for number in range(CHEF_REQUESTS)]
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_requests_faster_than_a_connection_by_request(self):
+        pooled = dicto.make_chef_transport(insecure=True)
+        connection = timed(lambda: [connection_request(url) for url in self.urls])
+        pool = timed(lambda: [pooled(u'GET', url, None, {}) for url in self.urls])
+
+        logger.info(u'{} chef requests: connection by request {:.3f}s, pooled {:.3f}s'
+                    .format(CHEF_REQUESTS, connection, pool))
+        assert_that(pool, less_than(connection))
+
+
+def connection_request(url):
+    """Previous chef transport: new SSL context and connection by request"""
+    import ssl
+    from six.moves.urllib.request import urlopen
+
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return urlopen(url, context=context).read()
+
+
+class TestTemplateCache(object):
+    def setup(self):
+        self.home = tempfile.mkdtemp(prefix=u'dicto-bench-home')
+        self.template = make_synthetic_template(TEMPLATE_MACROS)
+        os.environ[u'DICTO_HOME'] = self.home
+
+    def teardown(self):
+        del os.environ[u'DICTO_HOME']
+        dicto.template_environments.clear()
+
+    def test_it_loads_cached_templates_faster_than_compiling(self):
+        def load():
+            dicto.template_environments.clear()  # as a new process
+            return dicto.make_template(self.template)
+
+        compiled = timed(load)
+        cached = timed(load)
+
+        logger.info(u'{} macros template: compiled {:.3f}s, cached {:.3f}s'
+                    .format(TEMPLATE_MACROS, compiled, cached))
+        assert_that(cached, less_than(compiled))
+
+
+class TestStreamingRender(object):
+    def setup(self):
+        if sys.version_info < (3, 4):
+            raise SkipTest(u'tracemalloc needs python 3.4')
+        self.home = tempfile.mkdtemp(prefix=u'dicto-bench-home')
+        self.template = os.path.join(ROOT, u'examples', u'git.tpl.txt')
+        self.context = make_synthetic_git_context(RENDER_COMMITS)
+        os.environ[u'DICTO_HOME'] = self.home
+
+    def teardown(self):
+        os.environ.pop(u'DICTO_HOME', None)
+        dicto.template_environments.clear()
+
+    def test_it_renders_in_less_memory_than_a_full_document(self):
+        def write(content):
+            with open(os.path.join(self.home, u'out.txt'), u'w') as output:
+                dicto.write_output(content, output)
+
+        dicto.make_template(self.template)  # compile out of the measure
+        full = peak_memory(lambda: write(dicto.render_template(self.template, self.context)))
+        stream = peak_memory(lambda: write(dicto.stream_template(self.template, self.context)))
+
+        logger.info(u'{} commits render peak memory: full {}KiB, streamed {}KiB'
+                    .format(RENDER_COMMITS, full // 1024, stream // 1024))
+        assert_that(stream, less_than(full))
+
+
+class TestPrependOutput(object):
+    def setup(self):
+        if sys.version_info < (3, 4):
+            raise SkipTest(u'tracemalloc needs python 3.4')
+        self.path = make_synthetic_changelog(PREPEND_SIZE)
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_it_prepends_in_constant_memory(self):
+        content = (u'Release {}\n'.format(number) for number in range(1000))
+        peak = peak_memory(lambda: dicto.write_output(content, prepend=self.path))
+
+        logger.info(u'{} MiB prepend peak memory: {}KiB'.format(PREPEND_SIZE, peak // 1024))
+        assert_that(peak, less_than(PREPEND_BUDGET * 1024 * 1024))
+
+
+def make_synthetic_changelog(size):
+    """Creates a changelog file of *size* MiB"""
+    fd, path = tempfile.mkstemp(prefix=u'dicto-bench-changelog')
+    line = b'* Commit number 0000000 changes some file in some way\n'
+    block = line * (1024 * 1024 // len(line)) + b'\n' * (1024 * 1024 % len(line))
+    with os.fdopen(fd, 'wb') as stream:
+        for _ in range(size):
+            stream.write(block)
+    return path
+
+
+def make_synthetic_git_context(commits):
+    """Context for examples/git.tpl.txt with *commits* commits"""
+    commit = collections.namedtuple(u'Commit', [u'name_rev', u'message', u'author'])
+    commits = [commit(u'{:040x} master~{}'.format(number, number),
+                      u'Commit number {}\n\nChanges file {}'.format(number, number % 10),
+                      u'Dicto <dicto@example.com>')
+               for number in range(commits)]
+    return dict(git_commits=commits, git_version=u'v1',
+                git_version_tag=dict(rev=u'1'), git_version_commits=[])
+
+
+def make_synthetic_template(macros):
+    """Creates a template defining and calling *macros* macros"""
+    path = os.path.join(tempfile.mkdtemp(prefix=u'dicto-bench-tpl'), u'tpl.txt')
+    with open(path, 'w') as stream:
+        for number in range(macros):
+            stream.write(
+                u'{{% macro item{0}(commit) %}}'
+                u'{{% if commit.tags %}}[{{{{ commit.tags|join(", ") }}}}] {{% endif %}}'
+                u'{{{{ commit.author }}}}: {{{{ commit.message|truncate(80) }}}}'
+                u'{{% endmacro %}}\n'
+                u'{{% for commit in commits %}}{{{{ item{0}(commit) }}}}{{% endfor %}}\n'
+                .format(number))
+    return path
+
+
+def render_commits(commits):
+    """Reads the commit attributes used by examples/git.tpl.txt"""
+    return [(commit.name_rev, commit.author, commit.message)
+            for commit in commits]
+
+
+def timed(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def make_synthetic_git_repo(commits):
+    """Creates a git repository with *commits* commits using fast-import"""
+    path = tempfile.mkdtemp(prefix=u'dicto-bench-git')
+    subprocess.check_call([u'git', u'init', u'-q', path])
+
+    stream = []
+    for number in range(1, commits + 1):
+        message = u'Commit number {}\n\nChanges file {}\n'.format(number, number % 10)
+        content = u'{}\n'.format(number)
+        stream.append(
+            u'commit refs/heads/master\n'
+            u'committer Dicto <dicto@example.com> {} +0000\n'
+            u'data {}\n{}'
+            u'M 644 inline file{}.txt\n'
+            u'data {}\n{}\n'.format(1400000000 + number, len(message), message,
+                                     number % 10, len(content), content))
+        if number % 50 == 0:
+            stream.append(u'tag v{}\nfrom refs/heads/master\n'
+                          u'tagger Dicto <dicto@example.com> {} +0000\n'
+                          u'data 0\n\n'.format(number, 1400000000 + number))
+
+    process = subprocess.Popen([u'git', u'-C', path, u'fast-import', u'--quiet'],
+                               stdin=subprocess.PIPE)
+    process.communicate(u''.join(stream).encode(u'utf-8'))
+    return path
+
+
+def peak_memory(function):
+    """Peak of the python memory allocated while running *function*"""
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def make_synthetic_hg_repo(commits):
+    """Creates a linear mercurial repository with *commits* changesets"""
+    path = tempfile.mkdtemp(prefix=u'dicto-bench-hg')
+    subprocess.check_call([u'hg', u'init', path])
+    subprocess.check_call([u'hg', u'-R', path, u'debugbuilddag',
+                           u'+{}'.format(commits)])
+    return path
+
+
+def imported_modules(statement):
+    """Names of all the modules imported, at any depth, by *statement*
+
+    Runs *statement* in a new interpreter out of the reach of any config
+    file.
+    """
+    home = tempfile.mkdtemp(prefix=u'dicto-bench')
+    env = dict(os.environ, PYTHONPATH=ROOT, DICTO_HOME=home)
+    env.pop(u'DICTO_CONFIG', None)
+
+    output = subprocess.check_output(
+        [sys.executable, u'-c', statement + u'; import sys; print("\\n".join(sys.modules))'],
+        cwd=home, env=env)
+    return set(output.decode(u'utf-8').splitlines())
+
+
+def import_times(statement):
+    """Top level imports cumulative time in microseconds by module name
+
+    Runs *statement* in a new interpreter with ``-X importtime`` out of
+    the reach of any config file.
+    """
+    if sys.version_info < (3, 7):
+        raise SkipTest(u'-X importtime needs python 3.7')
+
+    home = tempfile.mkdtemp(prefix=u'dicto-bench')
+    env = dict(os.environ, PYTHONPATH=ROOT, DICTO_HOME=home)
+    env.pop(u'DICTO_CONFIG', None)
+
+    process = subprocess.Popen(
+        [sys.executable, u'-X', u'importtime', u'-c', statement],
+        cwd=home, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, output = process.communicate()
+
+    times = {}
+    for line in output.decode(u'utf-8').splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\S.*)$', line)
+        if match:  # only top level imports, not indented ones
+            times[match.group(3)] = int(match.group(1)), int(match.group(2))
+    return times
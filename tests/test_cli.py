@@ -1,17 +1,39 @@
 from __future__ import print_function
 
+import io
 import os
 import re
+import gzip
+import json
+import hashlib
+import time
 import logging
+import tempfile
+import threading
+import subprocess
 import traceback
 from datetime import datetime
+from importlib import import_module
+from unittest import SkipTest
 
-from hamcrest import (assert_that, all_of, has_property, has_properties,
-                      anything, contains_inanyorder, contains_string,
-                      matches_regexp)
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qsl
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import urlopen
 
-from dicto import cli
+from hamcrest import (assert_that, all_of, has_property, has_properties,
+                      anything, contains, contains_inanyorder, contains_string,
+                      equal_to, has_entries, has_item, has_length, is_not,
+                      less_than, matches_regexp, same_instance)
+
+import dicto
+from dicto import (Cache, chef_start_api, cli, evict_hg_mirrors, fetch_git_data,
+                   file_lock, git_tag_index, hg_mirror, iter_polled_changes,
+                   iter_watched_changes, make_chef_transport, make_render_server,
+                   RedmineStore, render_output_path, RenderService, ResourceCache,
+                   WatchedContext, resource_plan)
 from click.testing import CliRunner
+from requests.exceptions import SSLError
 
 
 logger = logging.getLogger(u'tests.cli')
@@ -54,7 +76,7 @@ class CommandTest(object):
 
 class TestCommands(CommandTest):
     def test_command_list(self):
-        commands = (u'shell', u'view', u'context')
+        commands = (u'shell', u'view', u'render-batch', u'serve', u'context', u'cache')
         has_commands = (has_property(u'name', name) for name in commands)
         assert_that(cli.commands.values(), contains_inanyorder(*has_commands))
 
@@ -79,6 +101,176 @@ class TestDefaultContext(CommandTest):
             u'current_date: ' + date_to_minutes))
 
 
+class TestTemplateOption(CommandTest):
+    env = {}  # clear config paths in env
+
+    def test_it_includes_templates_relative_to_template(self):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'header.txt', u'templates', contents=u'Release {{name}}')
+            template = make_config(path, u'tpl.txt', contents=u'{% include "header.txt" %}')
+            os.rename(template, os.path.join(path, u'templates', u'tpl.txt'))
+
+            self.run([u'view', u'--template', u'templates/tpl.txt', u'--data', u'name:1.0'],
+                     env={u'DICTO_HOME': path})
+            cached = os.listdir(os.path.join(path, u'cache', u'templates'))
+
+        self.assert_result(output=equal_to(u'Release 1.0\n'))
+        assert_that(cached, has_length(2))
+
+    def test_it_does_not_cache_compiled_configs(self):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'.dicto.yaml', contents=u'redmine_password: s3cret')
+            template = make_config(path, u'tpl.txt', contents=u'{{ name }}')
+
+            self.run([u'view', u'--template', template, u'--data', u'name:1.0'],
+                     env={u'DICTO_HOME': path})
+            directory = os.path.join(path, u'cache', u'templates')
+            cached = [io.open(os.path.join(directory, name), 'rb').read().decode('latin-1')
+                      for name in os.listdir(directory)]
+
+        self.assert_result(output=equal_to(u'1.0\n'))
+        assert_that(cached, all_of(has_length(1),
+                                   is_not(has_item(contains_string(u's3cret')))))
+
+    def test_it_fails_on_errors_raised_while_rendering(self):
+        with self.runner.isolated_filesystem() as path:
+            template = make_config(path, u'tpl.txt', contents=(
+                u'{% for n in range(3) %}{{ n }}{% endfor %}{{ missing.name }}'))
+
+            self.run([u'view', u'--template', template], env={u'DICTO_HOME': path})
+
+        self.assert_result(exit_code=1, output=contains_string(u'in template'))
+
+    def test_it_writes_documents_larger_than_its_buffer(self):
+        with self.runner.isolated_filesystem() as path:
+            template = make_config(path, u'tpl.txt', contents=(
+                u'{% for n in range(20000) %}line {{ n }}\n{% endfor %}'))
+            output = os.path.join(path, u'out.txt')
+
+            self.run([u'view', u'--template', template, u'--output', output],
+                     env={u'DICTO_HOME': path})
+            with io.open(output, encoding=u'utf-8') as stream:
+                lines = stream.read().splitlines()
+
+        self.assert_result()
+        assert_that(lines, all_of(has_length(20000), has_item(u'line 19999')))
+
+    def test_it_prepends_output_to_existing_file(self):
+        with self.runner.isolated_filesystem() as path:
+            template = make_config(path, u'tpl.txt', contents=u'Release {{name}}')
+            changelog = make_config(path, u'CHANGELOG', contents=u'Release 0.9\n')
+            os.chmod(changelog, 0o644)
+
+            self.run([u'view', u'--template', template, u'--data', u'name:1.0',
+                      u'--prepend', changelog], env={u'DICTO_HOME': path})
+            with io.open(changelog, encoding=u'utf-8') as stream:
+                contents = stream.read()
+            mode = os.stat(changelog).st_mode & 0o777
+
+        self.assert_result()
+        assert_that(contents, equal_to(u'Release 1.0\nRelease 0.9\n'))
+        assert_that(mode, equal_to(0o644))
+
+    def test_it_keeps_prepended_file_when_rendering_fails(self):
+        with self.runner.isolated_filesystem() as path:
+            template = make_config(path, u'tpl.txt', contents=u'Release {{ missing.name }}')
+            changelog = make_config(path, u'CHANGELOG', contents=u'Release 0.9\n')
+
+            self.run([u'view', u'--template', template, u'--prepend', changelog],
+                     env={u'DICTO_HOME': path})
+            with io.open(changelog, encoding=u'utf-8') as stream:
+                contents = stream.read()
+            files = os.listdir(path)
+
+        self.assert_result(exit_code=1)
+        assert_that(contents, equal_to(u'Release 0.9\n'))
+        assert_that(files, is_not(has_item(matches_regexp(u'^\\.dicto-'))))
+
+
+class TestRenderBatch(CommandTest):
+    env = {}  # clear config paths in env
+
+    def test_it_renders_every_target_from_a_single_context(self):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'changelog.tpl', contents=u'Release {{version}}')
+            make_config(path, u'email.tpl', contents=u'Hi, {{version}} is out')
+            make_config(path, u'CHANGELOG', contents=u'Release 0.9\n')
+            make_config(path, u'email.txt', contents=u'Hi, 0.9 is out\n')
+            manifest = make_config(path, u'manifest.yaml', contents=RENDER_MANIFEST)
+
+            self.run([u'render-batch', manifest,
+                      u'--exe', u'version:echo run >> runs.txt; printf 1.0'],
+                     env={u'DICTO_HOME': path})
+            contents = [read_file(os.path.join(path, name))
+                        for name in (u'CHANGELOG', u'email.txt', u'runs.txt')]
+
+        self.assert_result(output=equal_to(u'Release 1.0\n'))
+        assert_that(contents, contains(u'Release 1.0\nRelease 0.9\n',
+                                       u'Hi, 0.9 is out\n\nHi, 1.0 is out',
+                                       u'run\n'))
+
+    def test_it_renders_git_commits_for_every_target(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second', u'third'], tags={3: u'v1'})
+            make_config(path, u'changelog.tpl', contents=u'n={{ git_commits|list|length }}')
+            make_config(path, u'email.tpl', contents=u'n={{ git_commits|list|length }}')
+            make_config(path, u'CHANGELOG')
+            manifest = make_config(path, u'manifest.yaml', contents=RENDER_MANIFEST)
+
+            self.run([u'render-batch', manifest, u'--no-cache', u'--git', u'--git-repo', repo,
+                      u'--git-version', u'v1', u'--git-backend', u'log'],
+                     env={u'DICTO_HOME': path})
+            contents = [read_file(os.path.join(path, name))
+                        for name in (u'CHANGELOG', u'email.txt')]
+
+        self.assert_result(output=contains_re(r'^n=3$'))
+        assert_that(contents, contains(u'n=3\n', u'\nn=3'))
+
+    def test_it_reports_every_failed_target(self):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'changelog.tpl', contents=u'Release {{version}}')
+            make_config(path, u'email.tpl', contents=u'Hi, {{ missing.name }}')
+            manifest = make_config(path, u'manifest.yaml', contents=RENDER_MANIFEST)
+
+            self.run([u'render-batch', manifest, u'--data', u'version:1.0'],
+                     env={u'DICTO_HOME': path})
+
+        self.assert_result(exit_code=1, output=all_of(
+            contains_re(r'^Release 1.0$'),
+            contains_string(u'Could not render 2 target(s)'),
+            contains_re(r'changelog.tpl into .*CHANGELOG: .*No such file'),
+            contains_re(r'email.tpl into .*email.txt: .*missing. is undefined')))
+
+
+class TestRenderOutputPath(object):
+    def test_it_creates_the_same_directories_from_many_workers(self):
+        path = tempfile.mkdtemp(prefix=u'dicto-output')
+        start, errors = threading.Event(), []
+
+        def render(number):
+            start.wait()
+            try:
+                render_output_path(u'{{ out }}/{{ attempt }}/a/b/c/d/{{ number }}.txt',
+                                   dict(out=path, attempt=attempt, number=number))
+            except Exception:
+                errors.append(traceback.format_exc())
+
+        for attempt in range(20):
+            start.clear()
+            threads = [threading.Thread(target=render, args=(number,))
+                       for number in range(8)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+        assert_that(errors, has_length(0))
+        assert_that(os.path.isdir(os.path.join(path, u'19', u'a', u'b', u'c', u'd')),
+                    equal_to(True))
+
+
 class TestDataOption(CommandTest):
     env = {}  # clear config paths in env
 
@@ -132,6 +324,50 @@ class TestExeOption(CommandTest):
             contains_re(r'^key2: value2'),
         ))
 
+    def test_it_runs_commands_at_the_same_time(self):
+        # each command waits for the other one to start
+        wait = u'touch {}; for i in $(seq 100); do [ -e {} ] && break; sleep 0.1; done; ls {}'
+        with self.runner.isolated_filesystem():
+            self.run(['context',
+                      u'--exe', u'key1:' + wait.format(u'one', u'two', u'two'),
+                      u'--exe', u'key2:' + wait.format(u'two', u'one', u'one')])
+
+        self.assert_result(output=all_of(
+            contains_re(r'^key1: two$'),
+            contains_re(r'^key2: one$'),
+        ))
+
+    def test_it_kills_commands_after_timeout(self):
+        start = time.time()
+        self.run(['context', u'--exe-timeout', u'0.5',
+                  u'--exe', u'key1:sleep 10; echo value1'])
+
+        self.assert_result(output=all_of(
+            contains_string(u'The program was killed after 0.5s'),
+            contains_re(r'^key1: None'),
+        ))
+        assert_that(time.time() - start, less_than(5))
+
+    def test_it_caches_outputs_until_inputs_change(self):
+        with self.runner.isolated_filesystem() as path:
+            input = os.path.join(path, u'input.txt')
+            make_config(path, u'.dicto.yaml', contents=EXE_CACHE_CONFIG)
+            create_file(input, u'first')
+            os.utime(input, (1, 1))
+            outputs = [self.run_exe(path)]
+            create_file(input, u'second')
+            os.utime(input, (1, 1))
+            outputs.append(self.run_exe(path))
+            os.utime(input, (2, 2))
+            outputs.append(self.run_exe(path))
+
+        assert_that(outputs, contains(u'first', u'first', u'second'))
+
+    def run_exe(self, path):
+        self.run(['context'], env={u'DICTO_HOME': path})
+        self.assert_result()
+        return re.search(r'^key1: (.*)$', self.result.output, re.MULTILINE).group(1)
+
 
 class TestFileOption(CommandTest):
     env = {}  # clear config paths in env
@@ -155,6 +391,796 @@ class TestFileOption(CommandTest):
         ))
 
 
+class TestResourcesFetch(CommandTest):
+    env = {}  # clear config paths in env
+
+    def test_it_reports_every_failed_resource(self):
+        """Fetches resources concurrently reporting each failure"""
+        self.run(['context', u'--jobs', u'2',
+                  u'--git', u'--git-repo', u'/non/existent/repo',
+                  u'--git-version', u'1.0',
+                  u'--apt', u'--apt-url', u'http://127.0.0.1:1',
+                  u'--apt-packages', u'dicto'])
+
+        self.assert_result(exit_code=1, output=all_of(
+            contains_string(u'Could not fetch 2 resource(s)'),
+            contains_re(r'^  apt: '),
+            contains_re(r'^  git: '),
+        ))
+
+    def test_it_rejects_invalid_jobs(self):
+        self.run(['context', u'--jobs', u'0'])
+
+        self.assert_result(exit_code=2)
+
+
+class TestPruneOption(CommandTest):
+    env = {}  # clear config paths in env
+
+    def test_it_skips_resources_not_used_by_template(self):
+        with self.runner.isolated_filesystem() as path:
+            template = make_config(path, u'tpl.txt', contents=u'Hi {{name}}')
+
+            self.run(['view', u'--prune', u'--template', template,
+                      u'--data', u'name:dicto',
+                      u'--git', u'--git-repo', u'/non/existent/repo',
+                      u'--git-version', u'1.0'])
+
+        self.assert_result(output=contains_string(u'Hi dicto'))
+
+    def test_it_leaves_unused_resource_variables_out(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second'], tags={2: u'v1'})
+            template = make_config(path, u'tpl.txt', contents=u'{{git_version_commits}}')
+
+            self.run(['context', u'--no-cache', u'--prune', u'--template', template,
+                      u'--git', u'--git-repo', repo, u'--git-version', u'v1',
+                      u'--git-backend', u'log'])
+
+        self.assert_result(output=all_of(
+            contains_re(r'^git_version_commits: \[<GitCommit'),
+            contains_re(r'^git_repo: {}$'.format(re.escape(repo))),
+            is_not(contains_string(u'git_tags')),
+        ))
+
+    def test_it_explains_pruned_resources(self):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'commits.txt', contents=u'{{git_commits}}')
+            template = make_config(path, u'tpl.txt', contents=(
+                u'{{apt_packages}}{% include "commits.txt" %}'))
+
+            self.run(['view', u'--explain', u'--template', template,
+                      u'--git', u'--git-repo', u'/non/existent/repo',
+                      u'--git-version', u'1.0',
+                      u'--redmine', u'--redmine-url', u'http://127.0.0.1:1'])
+
+        self.assert_result(exit_code=1, output=all_of(
+            contains_re(r'^redmine: pruned, template uses none of redmine_api'),
+            contains_re(r'^git: fetched for git_commits; unused git_repo, '),
+            contains_re(r'^  git: '),
+        ))
+
+
+class TestResourcesCache(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestResourcesCache, self).setup()
+        self.server = serve_pages({
+            u'/pool/main/d/dicto': APT_POOL_PAGE,
+            u'/pool/main/d/dicto2': APT_POOL_PAGE.replace(u'dicto', u'dicto2'),
+        })
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_reuses_cached_resources(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_apt(path)
+            self.run_apt(path)
+            self.run([u'cache', u'stats'], env={u'DICTO_HOME': path})
+
+        self.assert_result(output=all_of(
+            contains_re(r'^entries: 1$'),
+            contains_re(r'^apt: 1 hits, 1 misses \(50% hit rate\)$'),
+        ))
+        assert_that(self.server.requests, has_length(1))
+
+    def test_it_evicts_entries_from_many_threads(self):
+        cache = Cache(tempfile.mkdtemp(prefix=u'dicto-cache'), max_size=20000)
+        errors = []
+
+        def fill(thread):
+            try:
+                for number in range(50):
+                    cache.set(cache.make_key(thread, number), u'x' * 1000)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fill, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_that(errors, has_length(0))
+        assert_that(cache.size(), less_than(20000 + 1))
+
+    def test_it_keys_resources_by_their_secrets(self):
+        cache = ResourceCache(tempfile.mkdtemp(prefix=u'dicto-cache'))
+        fetched = []
+
+        def fetch(needs=None, **kwargs):
+            fetched.append(kwargs[u'redmine_key'])
+            return dict(redmine_issues=[])
+
+        for key in (u'first', u'second', u'first'):
+            cache.fetch(resource_plan(u'redmine', fetch, dict(redmine_key=key),
+                                      (u'redmine_issues',)))
+
+        assert_that(fetched, contains(u'first', u'second'))
+        assert_that(cache.entries(), has_length(2))
+
+    def test_it_fetches_again_without_cache(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_apt(path)
+            self.run_apt(path, u'--refresh')
+            self.run_apt(path, u'--no-cache')
+
+        assert_that(self.server.requests, has_length(3))
+
+    def test_it_clears_cache(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_apt(path)
+            self.run([u'cache', u'clear'], env={u'DICTO_HOME': path})
+            self.run_apt(path)
+
+        assert_that(self.server.requests, has_length(2))
+
+    def test_it_revalidates_unchanged_pages(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_apt(path)
+            self.run_apt(path, u'--refresh')
+
+        assert_that(self.server.statuses, contains(200, 304))
+
+    def test_it_fetches_many_packages(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_apt(path, u'--apt-jobs', u'2',
+                         u'--apt-packages', u'dicto', u'--apt-packages', u'dicto2')
+
+        self.assert_result(output=contains_string(u'dicto2_1.0_all.deb'))
+
+    def run_apt(self, home, *args):
+        self.run([u'context', u'--apt', u'--apt-url', self.server.url,
+                  u'--apt-packages', u'dicto'] + list(args),
+                 env={u'DICTO_HOME': home})
+        self.assert_result(output=contains_string(u'dicto_1.0_all.deb'))
+
+
+class TestAptIndexBackend(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestAptIndexBackend, self).setup()
+        self.server = serve_pages({
+            u'/dists/stable/main/binary-amd64/Packages.gz': gzip_bytes(APT_INDEX),
+            u'/dists/testing/main/binary-amd64/Packages': APT_INDEX.replace(
+                u'1.0', u'1.1'),
+        })
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_gets_packages_from_index(self):
+        self.run_apt(u'--apt-packages', u'dicto', u'--apt-packages', u'libdicto')
+
+        self.assert_result(output=all_of(
+            contains_string(u"'url': '{}/pool/main/d/dicto/dicto_1.0_all.deb'"
+                            .format(self.server.url)),
+            contains_string(u"'url': '{}/pool/main/libd/libdicto'"
+                            .format(self.server.url)),
+            contains_re(r"'name': 'dicto_0.9_all.deb'.*'name': 'dicto_1.0_all.deb'"),
+        ))
+        assert_that(self.server.requests, has_length(1))
+
+    def test_it_merges_many_indexes(self):
+        self.run_apt(u'--apt-packages', u'dicto',
+                     u'--apt-index', u'dists/stable/main/binary-amd64/Packages.gz',
+                     u'--apt-index', u'dists/testing/main/binary-amd64/Packages')
+
+        self.assert_result(output=all_of(
+            contains_string(u'dicto_1.0_all.deb'),
+            contains_string(u'dicto_1.1_all.deb'),
+        ))
+
+    def test_it_fails_on_missing_indexes(self):
+        self.run_apt(u'--apt-packages', u'dicto',
+                     u'--apt-index', u'dists/unstable/main/binary-amd64/Packages')
+
+        self.assert_result(exit_code=1, output=contains_string(
+            u'apt: Could not get {}/dists/unstable/main/binary-amd64/Packages: HTTP 404'
+            .format(self.server.url)))
+
+    def run_apt(self, *args):
+        with self.runner.isolated_filesystem() as path:
+            self.run([u'context', u'--no-cache', u'--apt', u'--apt-backend', u'index',
+                      u'--apt-url', self.server.url] + list(args),
+                     env={u'DICTO_HOME': path})
+
+
+class TestGitLogBackend(CommandTest):
+    env = {}  # clear config paths in env
+
+    def test_it_renders_as_gitpython_backend(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second\n\nwith body', u'third'],
+                          tags={1: u'v1', 3: u'v2'})
+            template = make_config(path, u'tpl.txt', contents=GIT_TEMPLATE)
+
+            outputs = [self.run_git(repo, template, backend).output
+                       for backend in (u'gitpython', u'log')]
+
+        assert_that(outputs[1], all_of(
+            contains_string(u'tags/v2 Dicto Tester <dicto@example.com> third'),
+            contains_string(u'second\n\nwith body\n'),
+            equal_to(outputs[0]),
+        ))
+
+    def test_it_adds_version_stats(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second\n\nwith body', u'third'],
+                          tags={1: u'v1', 3: u'v2'})
+            template = make_config(path, u'tpl.txt', contents=GIT_STATS_TEMPLATE)
+
+            self.run_git(repo, template, u'log', u'--git-stats')
+
+        self.assert_result(output=all_of(
+            contains_re(r'^third 1 3.txt$'),
+            contains_re(r'^second 3 2.txt$'),
+            contains_re(r'^2 commits, 2 files, \+4 -0$'),
+            contains_string(u"[('2.txt', 3), ('3.txt', 1)]"),
+        ))
+
+    def test_it_gets_previous_version_in_history_order(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second', u'third'],
+                          tags={1: u'v1.9', 2: u'v1.10', 3: u'v2.0'})
+            template = make_config(path, u'tpl.txt', contents=GIT_TEMPLATE)
+
+            self.run_git(repo, template, u'log', u'--git-version', u'v2.0')
+
+        self.assert_result(output=all_of(
+            contains_string(u'revs v1.10..v2.0'),
+            contains_string(u'third'),
+            is_not(contains_string(u'second')),
+        ))
+
+    def test_it_reads_commits_when_used(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second'])
+
+            commits = fetch_git_data(repo, None, u'log')[u'git_commits']
+            git_commit(repo, u'third')
+
+            summaries = [[commit.summary for commit in commits] for _ in range(2)]
+
+        assert_that(summaries, contains(*[[u'third', u'second', u'first']] * 2))
+
+    def test_it_indexes_new_tags_in_nested_namespaces(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second'], tags={1: u'release/1.0'})
+
+            os.environ[u'DICTO_HOME'] = path
+            try:
+                before = git_tag_index(os.path.join(repo, u'.git'))
+                subprocess.check_call([u'git', u'-C', repo, u'tag', u'release/2.0'])
+                after = git_tag_index(os.path.join(repo, u'.git'))
+            finally:
+                del os.environ[u'DICTO_HOME']
+
+        assert_that(len(before), equal_to(1))
+        assert_that(after.previous(u'release/2.0'), equal_to(u'release/1.0'))
+
+    def test_it_clears_tag_indexes(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second'], tags={1: u'v1', 2: u'v2'})
+            template = make_config(path, u'tpl.txt', contents=GIT_TEMPLATE)
+            self.run_git(repo, template, u'log', env={u'DICTO_HOME': path})
+
+            self.run([u'cache', u'clear'], env={u'DICTO_HOME': path})
+            tags = os.listdir(os.path.join(path, u'cache', u'tags'))
+
+        assert_that(tags, is_not(has_item(matches_regexp(r'\.pickle$'))))
+
+    def run_git(self, repo, template, backend, *args, **kwargs):
+        self.run([u'view', u'--no-cache', u'--template', template, u'--git',
+                  u'--git-repo', repo, u'--git-version', u'v2',
+                  u'--git-backend', backend] + list(args), **kwargs)
+        self.assert_result()
+        return self.result
+
+
+class TestHgMirrors(CommandTest):
+    def test_it_evicts_unused_mirrors_not_in_use(self):
+        with self.runner.isolated_filesystem() as path:
+            mirrors = os.path.join(path, u'mirrors', u'hg')
+            for name in (u'old', u'locked', u'recent'):
+                os.makedirs(os.path.join(mirrors, name))
+            for name in (u'old', u'locked'):
+                os.utime(os.path.join(mirrors, name), (0, 0))
+
+            os.environ[u'DICTO_HOME'] = path
+            try:
+                with file_lock(os.path.join(mirrors, u'locked.lock')):
+                    evict_hg_mirrors(30)
+            finally:
+                del os.environ[u'DICTO_HOME']
+
+            remaining = sorted(name for name in os.listdir(mirrors)
+                               if os.path.isdir(os.path.join(mirrors, name)))
+
+        assert_that(remaining, contains(u'locked', u'recent'))
+
+    def test_it_pulls_into_the_existing_mirror(self):
+        if not has_command(u'hg'):
+            raise SkipTest(u'mercurial is not installed')
+
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_hg_repo(repo, [u'first'])
+            os.environ[u'DICTO_HOME'] = path
+            try:
+                with hg_mirror(repo) as mirror:
+                    create_file(os.path.join(mirror, u'.hg', u'marker'), u'first run')
+                hg_commit(repo, u'second')
+                with hg_mirror(repo) as pulled:
+                    marked = os.path.exists(os.path.join(pulled, u'.hg', u'marker'))
+                    log = subprocess.check_output([u'hg', u'--cwd', pulled, u'log',
+                                                   u'--template', u'{desc}\n'])
+            finally:
+                del os.environ[u'DICTO_HOME']
+
+        assert_that((pulled, marked), contains(mirror, True))
+        assert_that(log.decode(u'utf-8').split(), contains(u'second', u'first'))
+
+    def test_it_updates_mirrors_one_at_a_time(self):
+        if not has_command(u'hg'):
+            raise SkipTest(u'mercurial is not installed')
+
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_hg_repo(repo, [u'first'])
+            os.environ[u'DICTO_HOME'] = path
+            try:
+                with hg_mirror(repo) as mirror:
+                    pass
+
+                def update():
+                    with hg_mirror(repo):
+                        pass
+
+                with file_lock(mirror + u'.lock'):
+                    other = threading.Thread(target=update)
+                    other.start()
+                    other.join(0.5)
+                    waited = other.is_alive()
+                other.join()
+            finally:
+                del os.environ[u'DICTO_HOME']
+
+        assert_that((waited, other.is_alive()), contains(True, False))
+
+
+class TestHgLog(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestHgLog, self).setup()
+        if not has_command(u'hg'):
+            raise SkipTest(u'mercurial is not installed')
+
+    def test_it_reads_all_commits_newest_first(self):
+        self.run_hg([])
+
+        assert_that(self.result.output, equal_to(u'6: 5 4 3 2 1 0\n'))
+
+    def test_it_reads_commits_up_to_limit(self):
+        self.run_hg([u'--hg-log-limit', u'2'])
+
+        assert_that(self.result.output, equal_to(u'2: 5 4\n'))
+
+    def test_it_reads_commits_in_revset(self):
+        self.run_hg([u'--hg-revset', u'1::3'])
+
+        assert_that(self.result.output, equal_to(u'3: 1 2 3\n'))
+
+    def test_it_caches_hg_tags(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_hg_repo(repo, [u'first', u'second'], tags={2: u'v1'})
+            template = make_config(path, u'tpl.txt', contents=u'{{hg_version_tag.name}}')
+            args = [u'view', u'--prune', u'--template', template, u'--hg',
+                    u'--hg-repo', repo, u'--hg-version', u'v1']
+
+            outputs = [self.run(args, env={u'DICTO_HOME': path}).output for _ in range(2)]
+            self.run([u'cache', u'stats'], env={u'DICTO_HOME': path})
+
+        assert_that(outputs, contains(u'v1\n', u'v1\n'))
+        self.assert_result(output=contains_re(r'^hg: 1 hits, 1 misses'))
+
+    def run_hg(self, args):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_hg_repo(repo, [u'first', u'second', u'third', u'fourth', u'fifth'],
+                         tags={2: u'v1'})
+            template = make_config(path, u'tpl.txt', contents=HG_TEMPLATE)
+
+            self.run([u'view', u'--no-cache', u'--template', template, u'--hg',
+                      u'--hg-repo', repo, u'--hg-version', u'v1'] + args)
+            self.assert_result()
+
+
+class TestRedmineResource(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestRedmineResource, self).setup()
+        self.server = serve_pages({
+            u'/projects.json': redmine_projects,
+            u'/projects/dicto.json': json.dumps(dict(project=REDMINE_PROJECT)),
+            u'/projects/2.json': json.dumps(dict(project=REDMINE_PROJECT)),
+            u'/projects/2/versions.json': json.dumps(dict(
+                versions=[REDMINE_VERSION], total_count=1)),
+            u'/versions/7.json': json.dumps(dict(version=REDMINE_VERSION)),
+            u'/issues.json': redmine_issues,
+            u'/issue_statuses.json': json.dumps(dict(issue_statuses=[
+                dict(id=1, name=u'New', is_closed=False),
+                dict(id=5, name=u'Closed', is_closed=True)])),
+            u'/users/1.json': json.dumps(dict(user=dict(id=1, login=u'one'))),
+            u'/users/2.json': json.dumps(dict(user=dict(id=2, login=u'two'))),
+            u'/users/3.json': json.dumps(dict(user=dict(id=3, login=u'three'))),
+        })
+        self.server.pages.update(
+            (u'/issues/{}.json'.format(number),
+             json.dumps(dict(issue=redmine_issue(number, journals=True))))
+            for number in range(1, 251))
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_gets_project_by_identifier(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_redmine(path, u'dicto')
+
+        self.assert_result(output=equal_to(u'Dicto Tool 1.0\n'))
+        assert_that(self.server.requests,
+                    is_not(has_item(matches_regexp(r'^/projects.json'))))
+
+    def test_it_gets_project_and_version_by_name_from_index(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_redmine(path, u'dicto tool')
+            del self.server.requests[:]
+            self.run_redmine(path, u'Dicto Tool')
+
+        self.assert_result(output=equal_to(u'Dicto Tool 1.0\n'))
+        assert_that(self.server.requests, all_of(
+            has_item(matches_regexp(r'^/projects.json\?.*updated_on=%3E%3D2016-01-14')),
+            has_item(matches_regexp(r'^/versions/7.json')),
+            is_not(has_item(matches_regexp(r'^/projects/2/versions.json'))),
+        ))
+
+    def test_it_gets_issue_pages_at_once_in_bulk_mode(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_redmine(path, u'dicto', u'--redmine-bulk',
+                             u'--redmine-fields', u'subject',
+                             template=REDMINE_ISSUES_TEMPLATE)
+
+        self.assert_result(output=equal_to(u'250 issue 1 issue 250 id,subject\n'))
+        assert_that([r for r in self.server.requests if r.startswith(u'/issues.json')],
+                    contains_inanyorder(*[matches_regexp(r'offset={}(&|$)'.format(offset))
+                                          for offset in (0, 100, 200)]))
+
+    def test_it_prefetches_issue_attributes(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_redmine(path, u'dicto', u'--redmine-prefetch', u'relations',
+                             u'--redmine-prefetch', u'journals',
+                             u'--redmine-prefetch', u'assigned_to',
+                             template=REDMINE_PREFETCH_TEMPLATE)
+
+        self.assert_result(output=all_of(
+            contains_string(u'250 2 note 1 two\n'),
+            contains_string(u'in 256 requests, 494 saved'),
+        ))
+        assert_that([r for r in self.server.requests if u'issue_id=' in r], has_length(3))
+
+    def test_it_syncs_issues_store_by_changes(self):
+        with self.runner.isolated_filesystem() as path:
+            self.run_redmine(path, u'dicto', u'--redmine-store',
+                             template=REDMINE_ISSUES_TEMPLATE)
+            del self.server.requests[:]
+            self.run_redmine(path, u'dicto', u'--redmine-store',
+                             template=REDMINE_ISSUES_TEMPLATE)
+
+        self.assert_result(output=contains_string(u'250 issue 1 issue 250'))
+        assert_that([r for r in self.server.requests if r.startswith(u'/issues.json')],
+                    contains(matches_regexp(r'updated_on=%3E%3D2016-01-28T09%3A59%3A5')))
+
+    def test_it_syncs_again_issues_updated_while_syncing(self):
+        with self.runner.isolated_filesystem() as path:
+            store = RedmineStore(None, os.path.join(path, u'store.sqlite'))
+            store.update(2, [redmine_issue(27)], overlap=30.5)
+            last_sync = store.last_sync(2)
+            store.close()
+
+        assert_that(last_sync, equal_to(u'2016-01-28T09:59:29Z'))
+
+    def test_it_keeps_issues_store_on_interrupted_sync(self):
+        def issues():
+            yield redmine_issue(1)
+            raise IOError(u'connection lost')
+
+        with self.runner.isolated_filesystem() as path:
+            store = RedmineStore(None, os.path.join(path, u'store.sqlite'))
+            try:
+                store.update(2, issues())
+            except IOError:
+                pass
+
+            last_sync, stored = store.last_sync(2), store.issues(2, 7)
+            store.close()
+
+        assert_that(last_sync, equal_to(None))
+        assert_that(stored, has_length(0))
+
+    def run_redmine(self, path, project, *args, **kwargs):
+        template = make_config(path, u'tpl.txt',
+                               contents=kwargs.get(u'template', REDMINE_TEMPLATE))
+        self.run([u'view', u'--no-cache', u'--prune', u'--template', template,
+                  u'--redmine', u'--redmine-url', self.server.url,
+                  u'--redmine-key', u'secret', u'--redmine-project', project,
+                  u'--redmine-version', u'1.0'] + list(args), env={u'DICTO_HOME': path})
+
+
+class TestChefTransport(object):
+    def setup(self):
+        self.server = serve_pages({u'/nodes/web': u'{"name": "web"}'})
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_reuses_connections(self):
+        request = make_chef_transport()
+
+        contents = [request(u'GET', self.server.url + u'/nodes/web', None, {})
+                    for _ in range(3)]
+
+        assert_that(contents, contains(*[b'{"name": "web"}'] * 3))
+        assert_that(self.server.connections, has_length(1))
+
+    def test_it_raises_http_errors(self):
+        request = make_chef_transport()
+
+        code = None
+        try:
+            request(u'GET', self.server.url + u'/nodes/db', None, {})
+        except HTTPError as e:
+            code = e.code
+
+        assert_that(code, equal_to(404))
+
+    def test_it_skips_verification_when_the_config_says_so(self):
+        server = serve_pages({u'/nodes/web': u'{"name": "web"}'},
+                             ssl_context=make_server_ssl_context())
+        try:
+            insecure = chef_start_api_with(FakeChefApi(ssl_verify=False))
+            secure = chef_start_api_with(FakeChefApi(ssl_verify=True))
+
+            content = insecure._request(u'GET', server.url + u'/nodes/web', None, {})
+            failed = False
+            try:
+                secure._request(u'GET', server.url + u'/nodes/web', None, {})
+            except SSLError:
+                failed = True
+        finally:
+            stop_server(server)
+
+        assert_that(content, equal_to(b'{"name": "web"}'))
+        assert_that(failed, equal_to(True))
+
+
+class TestRenderServer(object):
+    def setup(self):
+        self.home = tempfile.mkdtemp(prefix=u'dicto-serve')
+        os.environ[u'DICTO_HOME'] = self.home
+        self.apt = serve_pages({u'/dists/stable/main/binary-amd64/Packages.gz':
+                                lambda query: time.sleep(0.5) or gzip_bytes(APT_INDEX)})
+        config = make_config(self.home, u'config.yaml',
+                             contents=PROFILES_CONFIG.format(url=self.apt.url))
+        template = make_config(self.home, u'tpl.txt', contents=PROFILES_TEMPLATE)
+
+        self.service = RenderService(config, dict(template=template, file={}, data={}, exe={}))
+        self.server = make_render_server(self.service)
+        self.server.url = u'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def teardown(self):
+        stop_server(self.server)
+        stop_server(self.apt)
+        del os.environ[u'DICTO_HOME']
+
+    def test_it_renders_profiles_reusing_fresh_resources(self):
+        contents = [self.get(u'/view?profile=' + name)
+                    for name in (u'first', u'second', u'first')]
+
+        assert_that(contents, contains(
+            (200, u'first: dicto_0.9_all.deb, dicto_1.0_all.deb'),
+            (200, u'second: dicto_0.9_all.deb, dicto_1.0_all.deb'),
+            (200, u'first: dicto_0.9_all.deb, dicto_1.0_all.deb')))
+        assert_that(self.apt.requests, has_length(1))
+
+    def test_it_fetches_once_for_requests_at_the_same_time(self):
+        threads = [threading.Thread(target=self.get, args=(u'/view?profile=first',))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _, metrics = self.get(u'/metrics')
+
+        assert_that(self.apt.requests, has_length(1))
+        assert_that(json.loads(metrics), has_entries(
+            renders=3, apt_fetches=1, apt_coalesced=2))
+
+    def test_it_forgets_expired_resources(self):
+        self.service.get_config()
+        self.service.ttls = {u'apt': 0}
+        self.get(u'/view?profile=first')
+        self.get(u'/view?profile=second')
+        with self.service.lock:
+            self.service.remove_expired()
+
+        assert_that(self.apt.requests, has_length(2))
+        assert_that(self.service.resources, has_length(0))
+
+    def test_it_renders_git_commits_more_than_once(self):
+        repo = os.path.join(self.home, u'repo')
+        make_git_repo(repo, [u'first', u'second', u'third'], tags={3: u'v1'})
+        template = make_config(self.home, u'git.txt', contents=u'{{ git_commits|list|length }}')
+        self.service.kwargs.update(template=template, git=True, git_repo=repo,
+                                   git_version=u'v1', git_backend=u'log')
+
+        contents = [self.get(u'/view?profile=first') for _ in range(2)]
+
+        assert_that(contents, contains((200, u'3'), (200, u'3')))
+
+    def test_it_does_not_let_request_data_set_options(self):
+        status, content = self.get(u'/view?profile=first&data=template:/etc/passwd'
+                                   u'&data=redmine_url:http://example.com&data=name:1.0')
+
+        assert_that(status, equal_to(500))
+        assert_that(content, equal_to(
+            u'Request data cannot set options: redmine_url, template'))
+
+    def test_it_answers_errors_and_health(self):
+        error_status, error = self.get(u'/view?profile=missing')
+        health_status, health = self.get(u'/health')
+
+        assert_that((error_status, health_status), equal_to((500, 200)))
+        assert_that(error, contains_string(u'Profile "missing" do not exists'))
+        assert_that(json.loads(health), has_entries(status=u'ok'))
+
+    def get(self, path):
+        try:
+            response = urlopen(self.server.url + path)
+            return response.getcode(), response.read().decode(u'utf-8')
+        except HTTPError as e:
+            return e.code, e.read().decode(u'utf-8')
+
+
+class TestWatch(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp(prefix=u'dicto-watch')
+        os.environ[u'DICTO_HOME'] = self.path
+
+    def teardown(self):
+        del os.environ[u'DICTO_HOME']
+
+    def test_it_updates_only_changed_inputs(self):
+        repo = os.path.join(self.path, u'repo')
+        make_git_repo(repo, [u'first', u'second'], tags={2: u'v1'})
+        notes = make_config(self.path, u'notes.txt', contents=u'old notes')
+        template = make_config(self.path, u'tpl.txt', contents=u'{{ notes }}')
+        watched = WatchedContext(None, dict(
+            template=template, git=True, git_repo=repo, git_version=u'v1',
+            git_backend=u'log', cache=False, file={u'notes': u'old notes'}, data={}, exe={}),
+            file_paths={u'notes': notes})
+
+        fetched = watched.context()
+        git_commit(repo, u'third')
+        create_file(notes, u'new notes')
+        watched.update({u'template'})
+        before = watched.context()
+        watched.update({u'git', u'file'})
+        after = watched.context()
+
+        assert_that(watched.sources(), has_entries({
+            template: u'template', notes: u'file',
+            os.path.join(repo, u'.git', u'refs'): u'git'}))
+        assert_that((before[u'git_commits'], before[u'notes']),
+                    contains(same_instance(fetched[u'git_commits']), u'old notes'))
+        assert_that((after[u'git_commits'], after[u'notes']),
+                    contains(is_not(same_instance(fetched[u'git_commits'])), u'new notes'))
+
+    def test_it_polls_changed_paths(self):
+        self.check_changes(iter_polled_changes)
+
+    def test_it_watches_changed_paths(self):
+        try:
+            import_module(u'watchdog')
+        except ImportError:
+            raise SkipTest(u'watchdog is not installed')
+        self.check_changes(iter_watched_changes)
+
+    def check_changes(self, iter_changes):
+        file = make_config(self.path, u'tpl.txt', contents=u'first')
+        directory = os.path.join(self.path, u'refs')
+        os.mkdir(directory)
+        changes = iter_changes([file, directory], 0.1)
+
+        time.sleep(0.1)
+        create_file(file, u'second')
+        changed = [next(changes)]
+        create_file(os.path.join(directory, u'master'), u'abc')
+        changed.append(next(changes))
+        changes.close()
+
+        assert_that(changed, contains({file}, {directory}))
+
+
+class TestChefSearch(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestChefSearch, self).setup()
+        try:
+            import_module(u'chef')
+        except Exception:
+            raise SkipTest(u'chef is not available in this platform')
+        self.server = serve_pages({
+            u'/environments': u'{}',
+            u'/search/node': chef_search_nodes,
+        })
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_gets_node_attributes_with_partial_search(self):
+        with self.runner.isolated_filesystem() as path:
+            make_chef_config(path, self.server.url)
+            template = make_config(path, u'tpl.txt', contents=CHEF_TEMPLATE)
+            self.run([u'view', u'--no-cache', u'--template', template, u'--chef',
+                      u'--chef-query', u'role:web', u'--chef-attributes',
+                      u'ip:network.ipaddress'])
+
+        self.assert_result(output=all_of(
+            contains_string(u'1200 web0000 10.0.0.0\n'),
+            contains_string(u'web1199 10.0.4.175\n'),
+        ))
+        assert_that([r for r in self.server.requests if r.startswith(u'/search')],
+                    contains_inanyorder(matches_regexp(r'start=0'),
+                                        matches_regexp(r'start=1000')))
+        assert_that(json.loads(self.server.bodies[0].decode('utf-8')), equal_to(
+            dict(name=[u'name'], ip=[u'network', u'ipaddress'])))
+
+
 class TestProfileOption(CommandTest):
     env = {}  # clear config paths in env
 
@@ -180,6 +1206,70 @@ profiles:
         ))
 
 
+class TestManyProfiles(CommandTest):
+    env = {}  # clear config paths in env
+
+    def setup(self):
+        super(TestManyProfiles, self).setup()
+        self.server = serve_pages({
+            u'/dists/stable/main/binary-amd64/Packages.gz': gzip_bytes(APT_INDEX),
+        })
+
+    def teardown(self):
+        stop_server(self.server)
+
+    def test_it_fetches_resources_shared_by_profiles_once(self):
+        outputs = self.run_profiles(u'--all-profiles', u'--jobs', u'3')
+
+        self.assert_result()
+        assert_that(outputs, contains(
+            (u'first.txt', u'first: dicto_0.9_all.deb, dicto_1.0_all.deb'),
+            (u'second.txt', u'second: dicto_0.9_all.deb, dicto_1.0_all.deb'),
+            (u'third.txt', u'third: libdicto_0.1_all.deb')))
+        assert_that(self.server.requests, has_length(2))
+
+    def test_it_renders_profiles_matching_a_glob(self):
+        outputs = self.run_profiles(u'--profile', u'*ir*')
+
+        self.assert_result()
+        assert_that(outputs, contains(
+            (u'first.txt', u'first: dicto_0.9_all.deb, dicto_1.0_all.deb'),
+            (u'third.txt', u'third: libdicto_0.1_all.deb')))
+
+    def test_it_renders_shared_git_commits_for_every_profile(self):
+        with self.runner.isolated_filesystem() as path:
+            repo = os.path.join(path, u'repo')
+            make_git_repo(repo, [u'first', u'second', u'third'], tags={3: u'v1'})
+            make_config(path, u'.dicto.yaml', contents=GIT_PROFILES_CONFIG.format(repo=repo))
+            make_config(path, u'tpl.txt', contents=u'{{ profile }}: {{ git_commits|list|length }}')
+
+            self.run([u'view', u'--all-profiles', u'--output-path', u'{{profile}}.txt'],
+                     env={u'DICTO_HOME': path})
+            outputs = [read_file(os.path.join(path, name)) for name in (u'one.txt', u'two.txt')]
+
+        self.assert_result()
+        assert_that(outputs, contains(u'one: 3', u'two: 3'))
+
+    def test_it_reports_failed_profiles_rendered_at_the_same_time(self):
+        self.run_profiles(u'--all-profiles', u'--jobs', u'2', template=(
+            u'{% if profile == "second" %}{{ missing.name }}{% endif %}' + PROFILES_TEMPLATE))
+
+        self.assert_result(exit_code=1, output=all_of(
+            contains_string(u'Could not render 1 target(s)'),
+            contains_re(r'tpl.txt into out/second.txt: .*missing. is undefined')))
+
+    def run_profiles(self, *args, **kwargs):
+        with self.runner.isolated_filesystem() as path:
+            make_config(path, u'.dicto.yaml', contents=PROFILES_CONFIG.format(url=self.server.url))
+            make_config(path, u'tpl.txt', contents=kwargs.get(u'template', PROFILES_TEMPLATE))
+
+            self.run([u'view', u'--output-path', u'out/{{profile}}.txt'] + list(args),
+                     env={u'DICTO_HOME': path})
+            out = os.path.join(path, u'out')
+            return [(name, read_file(os.path.join(out, name)))
+                    for name in sorted(os.listdir(out))] if os.path.isdir(out) else []
+
+
 class TestReadConfig(CommandTest):
     env = {}  # clear config paths in env
 
@@ -240,10 +1330,395 @@ def make_config(path, file, folder=None, contents=''):
     return file
 
 
+def read_file(path):
+    with io.open(path, encoding=u'utf-8') as stream:
+        return stream.read()
+
+
 def create_file(path, contents=''):
     with open(path, u'w') as stream:
         stream.write(contents)
 
 
+APT_POOL_PAGE = u'''<html><body><pre>
+<a href="dicto_0.9_all.deb">dicto_0.9_all.deb</a>   13-Jan-2016 10:00  1000
+<a href="dicto_1.0_all.deb">dicto_1.0_all.deb</a>   14-Jan-2016 10:00  1234
+</pre></body></html>
+'''
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+APT_INDEX = u'''Package: dicto
+Version: 1.0
+Filename: pool/main/d/dicto/dicto_1.0_all.deb
+Size: 1234
+Description: Text template processor
+ for message generation
+
+Package: libdicto
+Version: 0.1
+Filename: pool/main/libd/libdicto/libdicto_0.1_all.deb
+Size: 100
+
+Package: dicto
+Version: 0.9
+Filename: pool/main/d/dicto/dicto_0.9_all.deb
+Size: 1000
+'''
+
+
+REDMINE_TEMPLATE = u'''{{redmine_project.name}} {{redmine_version.name}}
+'''
+REDMINE_PROJECT = dict(id=2, identifier=u'dicto', name=u'Dicto Tool',
+                       updated_on=u'2016-01-14T10:00:00Z')
+REDMINE_VERSION = dict(id=7, name=u'1.0', project=dict(id=2, name=u'Dicto Tool'))
+
+
+def redmine_projects(query):
+    """Projects list page with the projects updated since the filter"""
+    other = dict(id=1, identifier=u'other', name=u'Other',
+                 updated_on=u'2015-01-01T10:00:00Z')
+    since = query.get(u'updated_on', u'>=')[2:]
+    projects = [p for p in (other, REDMINE_PROJECT) if p[u'updated_on'] >= since]
+    return json.dumps(dict(projects=projects, total_count=len(projects)))
+
+
+REDMINE_ISSUES_TEMPLATE = u'''{{redmine_issues|length}} \
+{{redmine_issues[0].subject}} {{redmine_issues[-1].subject}} \
+{{redmine_issues[0].keys()|sort|join(',')}}
+'''
+
+REDMINE_PREFETCH_TEMPLATE = u'''{% set issue = redmine_issues[0] %}\
+{{redmine_issues|length}} {{issue.relations[0].issue_to_id}} \
+{{issue.journals[0].notes}} {{issue.assigned_to.login}}
+'''
+
+
+def redmine_issues(query):
+    """Issues list page of 250 issues
+
+    Includes relations if asked, but never journals, as Redmine does.
+    """
+    offset, limit = int(query.get(u'offset', 0)), int(query.get(u'limit', 25))
+    numbers = range(1, 251)
+    if u'issue_id' in query:
+        numbers = [int(number) for number in query[u'issue_id'].split(u',')]
+
+    issues = [redmine_issue(number, u'relations' in query.get(u'include', u''))
+              for number in numbers]
+    issues = [issue for issue in issues
+              if issue[u'updated_on'] >= query.get(u'updated_on', u'>=')[2:]]
+    return json.dumps(dict(issues=issues[offset:offset + limit], total_count=len(issues),
+                           offset=offset, limit=limit))
+
+
+def redmine_issue(number, relations=False, journals=False):
+    issue = dict(id=number, subject=u'issue {}'.format(number),
+                 status=dict(id=5, name=u'Closed'),
+                 assigned_to=dict(id=number % 3 + 1, name=u'User'),
+                 project=dict(id=2, name=u'Dicto Tool'),
+                 fixed_version=dict(id=7, name=u'1.0'),
+                 updated_on=u'2016-01-{:02d}T10:00:00Z'.format(number % 28 + 1))
+    if relations:
+        issue[u'relations'] = [dict(id=number, issue_id=number,
+                                    issue_to_id=number + 1, relation_type=u'relates')]
+    if journals:
+        issue[u'journals'] = [dict(id=number, notes=u'note {}'.format(number))]
+    return issue
+
+
+CHEF_TEMPLATE = u'''{{chef_nodes|length}} \
+{% for name, node in chef_nodes.items() %}{{name}} {{node.ip}}
+{% endfor %}'''
+
+
+def make_server_ssl_context():
+    """Server SSL context with a new self-signed certificate"""
+    import ssl
+
+    path = tempfile.mkdtemp(prefix=u'dicto-ssl')
+    key, cert = os.path.join(path, u'key.pem'), os.path.join(path, u'cert.pem')
+    try:
+        subprocess.check_call([u'openssl', u'req', u'-x509', u'-newkey', u'rsa:2048',
+                               u'-nodes', u'-days', u'1', u'-subj', u'/CN=127.0.0.1',
+                               u'-keyout', key, u'-out', cert],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        raise SkipTest(u'openssl is not installed')
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class FakeChefApi(object):
+    """Chef api as autoconfigured from a knife.rb"""
+    def __init__(self, ssl_verify):
+        self.ssl_verify = ssl_verify
+
+
+def chef_start_api_with(api):
+    """Runs :func:`chef_start_api` as if PyChef autoconfigured *api*"""
+    class chef(object):
+        class api(object):
+            ChefRequest = None
+
+        autoconfigure = staticmethod(lambda: api)
+
+    import_chef, dicto.import_chef = dicto.import_chef, lambda: chef
+    try:
+        return chef_start_api()
+    finally:
+        dicto.import_chef = import_chef
+
+
+def chef_search_nodes(query):
+    """Partial search results page of 1200 nodes"""
+    start, rows = int(query[u'start']), int(query[u'rows'])
+    nodes = [dict(url=u'/nodes/web{:04d}'.format(number),
+                  data=dict(name=u'web{:04d}'.format(number),
+                            ip=u'10.0.{}.{}'.format(number // 256, number % 256)))
+             for number in range(1200)]
+    return json.dumps(dict(rows=nodes[start:start + rows], start=start, total=1200))
+
+
+def make_chef_config(path, url):
+    """Writes a knife config for *url* with a new client key"""
+    os.mkdir(os.path.join(path, u'.chef'))
+    subprocess.check_call([u'openssl', u'genrsa', u'-out',
+                           os.path.join(path, u'.chef', u'client.pem'), u'2048'],
+                          stderr=subprocess.PIPE)
+    create_file(os.path.join(path, u'.chef', u'knife.rb'),
+                u'chef_server_url "{}"\nnode_name "dicto"\nclient_key "client.pem"\n'
+                .format(url))
+
+
+RENDER_MANIFEST = u'''
+- template: changelog.tpl
+  output: CHANGELOG
+  mode: prepend
+- template: email.tpl
+  output: email.txt
+  mode: append
+- template: changelog.tpl
+'''
+
+PROFILES_CONFIG = u'''
+default:
+    template: tpl.txt
+    cache: false
+    apt: true
+    apt_backend: index
+    apt_url: {url}
+profiles:
+    first:
+        apt_packages: [dicto]
+    second:
+        apt_packages: [dicto]
+    third:
+        apt_packages: [libdicto]
+'''
+
+GIT_PROFILES_CONFIG = u'''
+default:
+    template: tpl.txt
+    cache: false
+    git: true
+    git_repo: {repo}
+    git_version: v1
+    git_backend: log
+profiles:
+    one: {{}}
+    two: {{}}
+'''
+
+PROFILES_TEMPLATE = (
+    u'{{ profile }}: {% for name, package in apt_packages.items() %}'
+    u'{{ package.versions|map(attribute="name")|join(", ") }}{% endfor %}')
+
+EXE_CACHE_CONFIG = u'''default:
+    exe:
+        key1:
+            command: cat input.txt
+            inputs: [input.txt]
+            cache: true
+'''
+
+
+GIT_TEMPLATE = u'''{% for commit in git_version_commits -%}
+{{commit.name_rev}} {{commit.author}} <{{commit.author.email}}> {{commit.summary}}
+{{commit.authored_date}} {{commit.message}}
+{% endfor %}'''
+
+
+HG_TEMPLATE = u'''{{hg_commits|length}}:\
+{% for commit in hg_commits %} {{commit.rev|int}}{% endfor %}
+'''
+
+
+GIT_STATS_TEMPLATE = u'''{% for commit in git_version_commits -%}
+{{commit.summary}} {{commit.stats.total.insertions}} {{commit.stats.files|join(',')}}
+{% endfor -%}
+{{git_version_stats.commits}} commits, {{git_version_stats.files}} files, \
++{{git_version_stats.insertions}} -{{git_version_stats.deletions}}
+{{git_version_stats.top_paths}}
+'''
+
+
+def make_git_repo(path, messages, tags=None):
+    """Creates a git repository with a commit for each message
+
+    Each commit adds a ``<number>.txt`` file with its message.
+    *tags* is a dict of tag names by commit number, starting at 1.
+    """
+    env = dict(os.environ, GIT_AUTHOR_NAME=u'Dicto Tester',
+               GIT_AUTHOR_EMAIL=u'dicto@example.com',
+               GIT_COMMITTER_NAME=u'Dicto Tester',
+               GIT_COMMITTER_EMAIL=u'dicto@example.com')
+
+    def git(*args):
+        subprocess.check_call((u'git', u'-C', path) + args, env=env,
+                              stdout=subprocess.PIPE)
+
+    subprocess.check_call([u'git', u'init', u'-q', path])
+    for number, message in enumerate(messages, 1):
+        # one commit per minute, so commits and tags have a history order
+        date = u'{} +0000'.format(1400000000 + number * 60)
+        env.update(GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        create_file(os.path.join(path, u'{}.txt'.format(number)), message + u'\n')
+        git(u'add', u'.')
+        git(u'commit', u'-q', u'-m', message)
+        if number in (tags or {}):
+            git(u'tag', tags[number])
+
+
+def git_commit(path, message):
+    env = dict(os.environ, GIT_AUTHOR_NAME=u'Dicto Tester',
+               GIT_AUTHOR_EMAIL=u'dicto@example.com',
+               GIT_COMMITTER_NAME=u'Dicto Tester',
+               GIT_COMMITTER_EMAIL=u'dicto@example.com')
+    subprocess.check_call([u'git', u'-C', path, u'commit', u'-q', u'--allow-empty',
+                           u'-m', message], env=env, stdout=subprocess.PIPE)
+
+
+def has_command(name):
+    try:
+        subprocess.check_call([name, u'--version'], stdout=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def make_hg_repo(path, messages, tags=None):
+    """Creates a mercurial repository with a commit for each message
+
+    *tags* is a dict of tag names by commit number, starting at 1. Tags
+    are added in a last commit.
+    """
+    def hg(*args):
+        subprocess.check_call((u'hg', u'--cwd', path, u'--config',
+                               u'ui.username=Dicto Tester <dicto@example.com>')
+                              + args, stdout=subprocess.PIPE)
+
+    subprocess.check_call([u'hg', u'init', path])
+    for number, message in enumerate(messages, 1):
+        create_file(os.path.join(path, u'{}.txt'.format(number)), message + u'\n')
+        hg(u'add', u'-q')
+        hg(u'commit', u'-m', message)
+    for number, name in sorted((tags or {}).items()):
+        hg(u'tag', u'-r', str(number - 1), name)
+
+
+def hg_commit(path, message):
+    create_file(os.path.join(path, message + u'.txt'), message + u'\n')
+    subprocess.check_call([u'hg', u'--cwd', path, u'--config',
+                           u'ui.username=Dicto Tester <dicto@example.com>',
+                           u'commit', u'-q', u'-A', u'-m', message], stdout=subprocess.PIPE)
+
+
+def gzip_bytes(text):
+    stream = io.BytesIO()
+    with gzip.GzipFile(fileobj=stream, mode='wb') as gzip_stream:
+        gzip_stream.write(text.encode('utf-8'))
+    return stream.getvalue()
+
+
+def serve_pages(pages, ssl_context=None):
+    """Serves a dict of path: content from a local HTTP server thread
+
+    Pages have an ETag, answering 304 when requested with it. Paths
+    without query string match any query, and their content can be a
+    function of the query dict. Serves HTTPS given an *ssl_context*.
+    POST requests are answered as GET ones, keeping their bodies.
+    """
+    requests = []
+    statuses = []
+    connections = set()
+    bodies = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = u'HTTP/1.1'
+        disable_nagle_algorithm = True  # no delayed responses on keep-alive
+
+        def do_GET(self):
+            requests.append(self.path)
+            connections.add(self.client_address)
+            url = urlparse(self.path)
+            body = pages.get(self.path, pages.get(url.path))
+            if body is None:
+                statuses.append(404)
+                return self.send_error(404)
+
+            if callable(body):
+                body = body(dict(parse_qsl(url.query)))
+            body = body.encode('utf-8') if not isinstance(body, bytes) else body
+            etag = u'"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get(u'If-None-Match') == etag:
+                statuses.append(304)
+                self.send_response(304)
+                self.send_header(u'ETag', etag)
+                self.send_header(u'Content-Length', u'0')
+                return self.end_headers()
+
+            statuses.append(200)
+            self.send_response(200)
+            self.send_header(u'ETag', etag)
+            self.send_header(u'Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get(u'Content-Length') or 0)
+            bodies.append(self.rfile.read(length))
+            self.do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((u'127.0.0.1', 0), Handler)
+    server.url = u'http://127.0.0.1:{}'.format(server.server_address[1])
+    if ssl_context:
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+        server.url = server.url.replace(u'http:', u'https:')
+    server.requests = requests
+    server.pages = pages
+    server.connections = connections
+    server.bodies = bodies
+    server.statuses = statuses
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
 def contains_re(text):
     return matches_regexp(re.compile(text, re.MULTILINE))